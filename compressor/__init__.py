@@ -1,19 +1,24 @@
+import errno
 import os
 import re
 import subprocess
+import threading
 from BeautifulSoup import BeautifulSoup
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
 from textwrap import dedent
 
 from django import template
 from django.conf import settings as django_settings
 from django.template.loader import render_to_string
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
+from django.core.cache import cache
 from django.core.files.storage import default_storage
+from django.utils.encoding import smart_str
 
-from compressor.conf import settings
-from compressor import filters
-from compressor.utils import get_hexdigest
+from compressor.conf import get_snapshot
+from compressor import filters, timing
+from compressor.utils import (get_domain, get_hexdigest, get_content_digest,
+    get_output_path, iter_file, mark_live, read_file, is_utf8, HashedFile)
 
 
 register = template.Library()
@@ -23,6 +28,14 @@ class UncompressableFileError(Exception):
     pass
 
 
+class BuildError(Exception):
+    """
+    Raised by a compress tag that waited for another thread or process to
+    build its bundle, when that build failed.
+    """
+    pass
+
+
 def exe_exists(program):
 
     def is_exe(fpath):
@@ -39,24 +52,28 @@ def exe_exists(program):
                 return True
     return False
 
+compile_lock = threading.Lock()
+
 class Compressor(object):
 
     def __init__(self, content, ouput_prefix="compressed", xhtml=False, media_url=None):
+        self.settings = getattr(self, 'settings', None) or get_snapshot()
         self.content = content
         self.ouput_prefix = ouput_prefix
         self.split_content = []
+        self._hunks = None
+        self._output = None
+        self._stream = None
+        stop = timing.start('parse', getattr(self, 'type', None))
         self.soup = BeautifulSoup(self.content)
+        stop()
         self.xhtml = xhtml
-        self.media_url = media_url or settings.MEDIA_URL
-        try:
-          from django.contrib.sites.models import Site
-          self.domain = Site.objects.get_current().domain
-        except:
-          self.domain = ''
+        self.media_url = media_url or self.settings.MEDIA_URL
 
-    def content_hash(self):
-        """docstring for content_hash"""
-        pass
+
+    @property
+    def domain(self):
+        return get_domain()
 
     def split_contents(self):
         raise NotImplementedError('split_contents must be defined in a subclass')
@@ -66,87 +83,223 @@ class Compressor(object):
             raise UncompressableFileError('"%s" is not in COMPRESS_URL ("%s") and can not be compressed' % (url, self.media_url))
         url = os.path.realpath(url)
         basename = url[len(self.media_url):]
-        filename = os.path.join(settings.MEDIA_ROOT, basename)
+        filename = os.path.join(self.settings.MEDIA_ROOT, basename)
         return os.path.realpath(filename)
 
     @property
     def mtimes(self):
         return (os.path.getmtime(h[1]) for h in self.split_contents() if h[0] == 'file')
 
+    @property
+    def content_hashes(self):
+        return (get_content_digest(h[1], self.settings) for h in self.split_contents() if h[0] == 'file')
+
+    @property
+    def cachekey_components(self):
+        """
+        The (name, value) pairs that make up the cachekey: the block's
+        content, the media url, the version of each linked file, the COMPRESS
+        setting and, with COMPRESS_SITE_CACHE_KEYS, the domain.
+        """
+        files = [h[1] for h in self.split_contents() if h[0] == 'file']
+        stop = timing.start('stat', self.type)
+        if self.settings.CONTENT_CACHE_KEYS:
+            versions = list(self.content_hashes)
+        else:
+            versions = [str(m) for m in self.mtimes]
+        stop()
+        components = [('content', self.content), ('media_url', self.media_url)]
+        components.extend(zip(['file %s' % f for f in files], versions))
+        components.append(('COMPRESS', str(self.settings.COMPRESS)))
+        if self.settings.SITE_CACHE_KEYS:
+            components.append(('domain', self.domain))
+        return components
+
     @property
     def cachekey(self):
         """
-        cachekey for this block of css or js.
+        cachekey for this block of css or js. It only depends on what goes
+        into the bundle, so sites sharing templates share bundles unless
+        COMPRESS_SITE_CACHE_KEYS is on.
         """
-        cachebits = [self.content]
-        cachebits.extend([str(m) for m in self.mtimes])
-        cachestr = "".join(cachebits)
-        return "%s.django_compressor.%s.%s" % (self.domain, get_hexdigest(cachestr)[:12], settings.COMPRESS)
+        cachestr = "".join([value for name, value in self.cachekey_components
+                            if name not in ('COMPRESS', 'domain')])
+        cachekey = "django_compressor.%s.%s" % (get_hexdigest(cachestr)[:12], self.settings.COMPRESS)
+        if self.settings.SITE_CACHE_KEYS:
+            return "%s.%s" % (self.domain, cachekey)
+        return cachekey
 
     @property
     def hunks(self):
         """
         Returns a list of processed data
         """
-        if getattr(self, '_hunks', ''):
-            return self._hunks
-        self._hunks = []
-        for kind, v, elem in self.split_contents():
-            if kind == 'hunk':
-                input = v
-                if self.filters:
-                    input = self.filter(input, 'input', elem=elem)
-                self._hunks.append(input)
-            if kind == 'file':
-                fd = open(v, 'rb')
-                input = fd.read()
-                if self.filters:
-                    input = self.filter(input, 'input', filename=v, elem=elem)
-                self._hunks.append(input)
-                fd.close()
+        if self._hunks is None:
+            self._hunks = list(self.iter_hunks())
         return self._hunks
 
+    def iter_hunks(self):
+        """
+        Yields the processed data one hunk at a time
+        """
+        for kind, v, elem in self.split_contents():
+            yield self.process_hunk(kind, v, elem)
+
+    def process_hunk(self, kind, v, elem):
+        """
+        Returns a hunk as a utf-8 encoded str, the only form content takes
+        between here and the storage backend.
+        """
+        if kind == 'hunk':
+            input = smart_str(v)
+            if self.filters:
+                input = self.filter(input, 'input', elem=elem)
+            return input
+        if kind == 'file':
+            stop = timing.start('read', self.type)
+            input = read_file(v, self.settings)
+            if not is_utf8(django_settings.FILE_CHARSET):
+                input = smart_str(input.decode(django_settings.FILE_CHARSET))
+            stop()
+            if self.filters:
+                input = self.filter(input, 'input', filename=v, elem=elem)
+            return input
+
+    def iter_chunks(self):
+        """
+        Yields the processed data hunk by hunk, with linked files passed
+        through in blocks when no input filter needs their whole content.
+        """
+        copy_files = is_utf8(django_settings.FILE_CHARSET) and not self.pipeline.input_filters
+        for i, (kind, v, elem) in enumerate(self.split_contents()):
+            if i:
+                yield "\n"
+            if kind == 'file' and copy_files:
+                for block in iter_file(v, settings=self.settings):
+                    yield block
+            else:
+                yield self.process_hunk(kind, v, elem)
+
     def concat(self):
         return "\n".join(self.hunks)
 
+    @property
+    def pipeline(self):
+        return filters.get_pipeline(self.filters, self.type)
+
     def filter(self, content, method, **kwargs):
-        for f in self.filters:
-            filter = getattr(filters.get_class(f)(content, filter_type=self.type), method)
-            try:
-                if callable(filter):
-                    content = filter(media_url=self.media_url, **kwargs)
-            except NotImplementedError:
-                pass
-        if type(content) == str:
-            return content
-        else:
-            return unicode(content).encode('utf-8')
+        stop = timing.start('filter_%s' % method, self.type)
+        content = self.pipeline.apply(content, method, media_url=smart_str(self.media_url),
+                                      settings=self.settings, **kwargs)
+        stop()
+        return content
 
     @property
     def combined(self):
-        if getattr(self, '_output', ''):
-            return self._output
-        output = self.concat()
-        filter_method = getattr(self, 'filter_method', None)
-        if self.filters:
-            output = self.filter(output, 'output')
-        self._output = output
+        if self._output is None:
+            output = self.concat()
+            if self.filters:
+                output = self.filter_output(output)
+            self._output = output
         return self._output
 
+    def filter_output(self, content):
+        """
+        Runs the output filters, reusing the cached result for identical
+        input when COMPRESS_CACHE_FILTER_OUTPUT is on.
+        """
+        if not self.settings.CACHE_FILTER_OUTPUT or not self.pipeline.output_filters:
+            return self.filter(content, 'output')
+        key = self.pipeline.output_cachekey(get_hexdigest(content), self.media_url)
+        output = cache.get(key)
+        if output is None:
+            output = self.filter(content, 'output')
+            cache.set(key, output, self.settings.FILTER_OUTPUT_TIMEOUT)
+        return output
+
+    def stream(self):
+        """
+        Streams the hunks through the output filters into a spooled temporary
+        file, hashing the result as it is written. Returns a tuple of the
+        rewound file, its hexdigest and its size.
+        """
+        if self._stream is not None:
+            return self._stream
+        output_filters = self.pipeline.stream_filters
+        current = self.spool()
+        target = HashedFile(current)
+        for chunk in self.iter_chunks():
+            target.write(smart_str(chunk))
+        key, cached = None, None
+        if output_filters and self.settings.CACHE_FILTER_OUTPUT:
+            key = self.pipeline.output_cachekey(target.hexdigest(), self.media_url, streaming=True)
+            cached = cache.get(key)
+        if cached is not None:
+            current.close()
+            current = self.spool()
+            target = HashedFile(current)
+            target.write(cached)
+            output_filters = []
+        stop = timing.start('filter_output', self.type)
+        for i, cls in enumerate(output_filters):
+            current.seek(0)
+            next = self.spool()
+            target = next
+            if i == len(output_filters) - 1:
+                target = HashedFile(next)
+            self.pipeline.apply_stream(cls, current, target, media_url=smart_str(self.media_url),
+                                       settings=self.settings)
+            current.close()
+            current = next
+        stop()
+        if output_filters and key and target.size <= self.settings.SPOOL_MAX_SIZE:
+            current.seek(0)
+            cache.set(key, current.read(), self.settings.FILTER_OUTPUT_TIMEOUT)
+        current.seek(0)
+        self._stream = (current, target.hexdigest(), target.size)
+        return self._stream
+
+    def spool(self):
+        return SpooledTemporaryFile(max_size=self.settings.SPOOL_MAX_SIZE)
+
     @property
     def hash(self):
-        return get_hexdigest(self.combined)[:12]
+        if self.settings.STREAMING:
+            return self.stream()[1][:12]
+        combined = self.combined
+        stop = timing.start('hash', self.type)
+        digest = get_hexdigest(combined)[:12]
+        stop()
+        return digest
 
     @property
     def new_filepath(self):
         filename = "".join((self.hash, self.extension))
-        filepath = "/".join((settings.OUTPUT_DIR.strip('/'), self.ouput_prefix, filename))
-        return filepath
+        return get_output_path(self.ouput_prefix, filename, self.settings)
 
     def save_file(self):
         if default_storage.exists(self.new_filepath):
             return False
-        default_storage.save(self.new_filepath, ContentFile(self.combined))
+        if self.settings.STREAMING:
+            spool, digest, size = self.stream()
+            content = File(spool)
+            content.size = size
+        else:
+            content = ContentFile(self.combined)
+        stop = timing.start('save', self.type)
+        try:
+            name = default_storage.save(self.new_filepath, content)
+        except OSError, e:
+            # another thread or process created the directory at the same time
+            if e.errno != errno.EEXIST:
+                raise
+            content.seek(0)
+            name = default_storage.save(self.new_filepath, content)
+        content.close()
+        if name != self.new_filepath:
+            # it saved the same bundle first, don't keep a copy
+            default_storage.delete(name)
+        stop()
         return True
 
     def return_compiled_content(self, content):
@@ -163,26 +316,47 @@ class Compressor(object):
         else:
             return os.linesep.join((re.sub("\s?/>",">",unicode(i[2])) for i in self.split_content)) 
         
-    def output(self):
+    @property
+    def size(self):
+        if self.settings.STREAMING:
+            return self.stream()[2]
+        return len(self.combined)
+
+    def inline_content(self):
+        if self.settings.STREAMING:
+            spool = self.stream()[0]
+            spool.seek(0)
+            return spool.read()
+        return self.combined
+
+    def output(self, inline=False):
         """
-        Return the versioned file path if COMPRESS = True
+        Return the versioned file path if COMPRESS = True, or the compressed
+        content itself if inline is True or it's no bigger than
+        COMPRESS_INLINE_THRESHOLD.
         """
-        if not settings.COMPRESS:
+        if not self.settings.COMPRESS:
             return self.return_compiled_content(self.content)
+        context = getattr(self, 'extra_context', {})
+        context['xhtml'] = self.xhtml
+        if inline or (self.settings.INLINE_THRESHOLD and self.size <= self.settings.INLINE_THRESHOLD):
+            context['content'] = self.inline_content()
+            return render_to_string(self.inline_template_name, context)
         url = "/".join((self.media_url.rstrip('/'), self.new_filepath))
         self.save_file()
-        context = getattr(self, 'extra_context', {})
+        mark_live(self.new_filepath)
         context['url'] = url
-        context['xhtml'] = self.xhtml
         return render_to_string(self.template_name, context)
 
 
 class CssCompressor(Compressor):
 
     def __init__(self, content, ouput_prefix="css", xhtml=False, media_url=None):
+        self.settings = get_snapshot()
         self.extension = ".css"
         self.template_name = "compressor/css.html"
-        self.filters = settings.COMPRESS_CSS_FILTERS
+        self.inline_template_name = "compressor/css_inline.html"
+        self.filters = self.settings.COMPRESS_CSS_FILTERS
         self.type = 'css'
         super(CssCompressor, self).__init__(content, ouput_prefix, xhtml, media_url)
     
@@ -198,8 +372,11 @@ class CssCompressor(Compressor):
             raise Exception("Path to CSS compiler must be included in COMPILER_FORMATS")
         arguments = compiler.get('arguments','').replace("*",filename)
         command = '%s %s' % (bin, arguments)
+        stop = timing.start('compile', 'css')
         p = subprocess.Popen(command,shell=True,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        if p.wait() != 0:
+        returncode = p.wait()
+        stop()
+        if returncode != 0:
             err = p.stderr.read()
             p.stderr.close()
             if not err:
@@ -213,7 +390,7 @@ class CssCompressor(Compressor):
         little hackish, but you shouldn't be compiling in production anyway,
         right?
         """
-        compiler = settings.COMPILER_FORMATS[ext]
+        compiler = self.settings.COMPILER_FORMATS[ext]
         try:
             bin = compiler['binary_path']
         except:
@@ -253,19 +430,25 @@ class CssCompressor(Compressor):
         """ Iterates over the elements in the block """
         if self.split_content:
             return self.split_content
+        split_content = []
         split = self.soup.findAll({'link' : True, 'style' : True})
         for elem in split:
             if elem.name == 'link' and elem['rel'] == 'stylesheet':
                 filename = self.get_filename(elem['href'])
                 path, ext = os.path.splitext(filename)
-                if ext in settings.COMPILER_FORMATS.keys():
-                    if self.recompile(filename):
-                        self.compile(path,settings.COMPILER_FORMATS[ext])
+                if ext in self.settings.COMPILER_FORMATS.keys():
+                    # so that no thread reads a file another is compiling
+                    compile_lock.acquire()
+                    try:
+                        if self.recompile(filename):
+                            self.compile(path,self.settings.COMPILER_FORMATS[ext])
+                    finally:
+                        compile_lock.release()
                     basename = os.path.splitext(os.path.basename(filename))[0]
                     elem = BeautifulSoup(re.sub(basename+ext,basename+'.css',unicode(elem)))
                     filename = path + '.css'
                 try:
-                    self.split_content.append(('file', filename, elem))
+                    split_content.append(('file', filename, elem))
                 except UncompressableFileError:
                     if django_settings.DEBUG:
                         raise
@@ -282,16 +465,19 @@ class CssCompressor(Compressor):
                     ext = '.'+elem_type
                     data = self.compile_inline(data,ext)
                     elem = ''.join(("<style type='text/css'>\n",data,"\n</style>"))
-                self.split_content.append(('hunk', data, elem))
+                split_content.append(('hunk', data, elem))
+        self.split_content = split_content
         return self.split_content
     
     
 class JsCompressor(Compressor):
 
     def __init__(self, content, ouput_prefix="js", xhtml=False, media_url=None):
+        self.settings = get_snapshot()
         self.extension = ".js"
         self.template_name = "compressor/js.html"
-        self.filters = settings.COMPRESS_JS_FILTERS
+        self.inline_template_name = "compressor/js_inline.html"
+        self.filters = self.settings.COMPRESS_JS_FILTERS
         self.type = 'js'
         super(JsCompressor, self).__init__(content, ouput_prefix, xhtml, media_url)
 
@@ -299,14 +485,16 @@ class JsCompressor(Compressor):
         """ Iterates over the elements in the block """
         if self.split_content:
             return self.split_content
+        split_content = []
         split = self.soup.findAll('script')
         for elem in split:
             if elem.has_key('src'):
                 try:
-                    self.split_content.append(('file', self.get_filename(elem['src']), elem))
+                    split_content.append(('file', self.get_filename(elem['src']), elem))
                 except UncompressableFileError:
                     if django_settings.DEBUG:
                         raise
             else:
-                self.split_content.append(('hunk', elem.string, elem))
+                split_content.append(('hunk', elem.string, elem))
+        self.split_content = split_content
         return self.split_content
@@ -0,0 +1,847 @@
+"""
+Benchmarks for the compression pipeline. Run them through the
+``compress_benchmark`` management command.
+"""
+import cProfile
+import multiprocessing
+import os
+import pstats
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+from django.conf import settings as django_settings
+from django.core.cache import cache, get_cache
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import connection, reset_queries
+from django.template import Context, Template
+from django.utils.encoding import smart_str
+
+import compressor as compressor_module
+from compressor import CssCompressor, JsCompressor, stats
+from compressor import filters as filters_module
+from compressor.conf import settings
+from compressor.filters import FilterBase, FilterError, get_class, implements
+from compressor.templatetags import compress as compress_module
+from compressor.utils import clear_domains
+
+
+class PassthroughFilter(FilterBase):
+    """
+    Returns its content untouched, so timings only measure the pipeline.
+    """
+    def input(self, **kwargs):
+        return self.content
+
+    def output(self, **kwargs):
+        return self.content
+
+
+def best_of(func, repeat=5, number=10, setup=None):
+    """
+    Returns the best average time in seconds of ``number`` calls to func
+    over ``repeat`` runs. ``setup`` is called before each call, untimed.
+    """
+    timings = []
+    for i in xrange(repeat):
+        elapsed = 0
+        for j in xrange(number):
+            if setup is not None:
+                setup()
+            start = time.time()
+            func()
+            elapsed += time.time() - start
+        timings.append(elapsed / number)
+    return min(timings)
+
+
+class CopyCounter(object):
+    """
+    Counts the strings of at least ``min_size`` characters that transcoding
+    copied: calls to smart_str that returned a new object, where Compressor
+    and FilterPipeline use it, and the copies legacy_filter reports.
+    """
+    modules = (compressor_module, filters_module)
+
+    def __init__(self, min_size):
+        self.min_size = min_size
+        self.copies = 0
+
+    def add(self, original, result):
+        if result is not original and len(result) >= self.min_size:
+            self.copies += 1
+        return result
+
+    def install(self):
+        def counted(s, *args, **kwargs):
+            return self.add(s, smart_str(s, *args, **kwargs))
+        for module in self.modules:
+            module.smart_str = counted
+
+    def uninstall(self):
+        for module in self.modules:
+            module.smart_str = smart_str
+
+
+def legacy_filter(content, filter_list, method, counter=None, **kwargs):
+    """
+    The filter chain as it was before content was kept as utf-8 bytes, kept
+    as a reference: every result that isn't an exact str is copied to
+    unicode, then encoded again.
+    """
+    counter = counter or CopyCounter(0)
+    for f in filter_list:
+        filter = getattr(get_class(f)(content), method)
+        result = filter(**kwargs)
+        if isinstance(result, unicode) and not isinstance(content, unicode):
+            # the filter decoded its str content, e.g. for a unicode media url
+            counter.add(content, result)
+        content = result
+    if type(content) == str:
+        return content
+    copy = counter.add(content, unicode(content))
+    return counter.add(copy, copy.encode('utf-8'))
+
+
+def bench_transcoding(size=512 * 1024, repeat=5, number=10):
+    """
+    Runs an inline hunk and a linked CSS file through Compressor.hunks and
+    Compressor.combined, and through legacy_filter as a reference, counting
+    the copies transcoding makes and timing them.
+
+    The legacy way copies an inline hunk twice after its filter chain
+    (unicode() of the soup string, then encode), Compressor encodes it once
+    when it's read. Neither copies a utf-8 linked file.
+    """
+    js_filters = ['compressor.benchmark.PassthroughFilter']
+    css_filters = ['compressor.filters.css_default.CssAbsoluteFilter']
+    line = u'var caf\xe9 = "\u2603"; // padding\n'
+    rule = 'p { background: url(../img/bg.png); }\n'
+    media_url = unicode(settings.MEDIA_URL)
+    directory = os.path.join(settings.MEDIA_ROOT, CORPUS_DIR)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filename = os.path.join(directory, 'transcoding.css')
+    fd = open(filename, 'w')
+    fd.write(rule * (size // len(rule)))
+    fd.close()
+    inline_block = u'<script type="text/javascript">%s</script>' % (line * (size // len(line)))
+    linked_block = u'<link rel="stylesheet" href="%s%s/transcoding.css" type="text/css">' % (media_url, CORPUS_DIR)
+
+    old_filters = settings.COMPRESS_JS_FILTERS, settings.COMPRESS_CSS_FILTERS
+    settings.COMPRESS_JS_FILTERS, settings.COMPRESS_CSS_FILTERS = js_filters, css_filters
+    try:
+        inline = JsCompressor(inline_block, media_url=media_url)
+        linked = CssCompressor(linked_block, media_url=media_url)
+    finally:
+        settings.COMPRESS_JS_FILTERS, settings.COMPRESS_CSS_FILTERS = old_filters
+    inline_string = inline.split_contents()[0][1]
+    linked.split_contents()
+
+    def legacy_inline(counter=None):
+        legacy_filter(inline_string, js_filters, 'input', counter)
+
+    def legacy_linked(counter=None):
+        content = open(filename).read()
+        legacy_filter(content, css_filters, 'input', counter, filename=filename, media_url=media_url)
+
+    def reset(compressor):
+        compressor._hunks = None
+        compressor._output = None
+
+    def hunks(compressor):
+        reset(compressor)
+        compressor.hunks
+
+    def combined(compressor):
+        reset(compressor)
+        compressor.combined
+
+    def count(func, *args):
+        counter = CopyCounter(size // 2)
+        counter.install()
+        try:
+            func(*args)
+        finally:
+            counter.uninstall()
+        return counter.copies
+
+    def legacy_copies(func):
+        counter = CopyCounter(size // 2)
+        func(counter)
+        return counter.copies
+
+    try:
+        results = {'size': size}
+        for name, compressor, legacy in (('inline', inline, legacy_inline), ('linked', linked, legacy_linked)):
+            results[name] = {
+                'legacy': {
+                    'time': best_of(legacy, repeat, number),
+                    'copies': legacy_copies(legacy),
+                },
+                'hunks': {
+                    'time': best_of(lambda: hunks(compressor), repeat, number),
+                    'copies': count(hunks, compressor),
+                },
+                'combined': {
+                    'time': best_of(lambda: combined(compressor), repeat, number),
+                    'copies': count(combined, compressor),
+                },
+            }
+    finally:
+        remove_corpora()
+    return results
+
+
+def bench_templatetag(repeat=5, number=10):
+    """
+    Measures how long importing the compress templatetag library takes, in a
+    fresh interpreter, and how many queries a cold and a warm render of a
+    compress block run with COMPRESS_SITE_CACHE_KEYS on. If the interpreter
+    fails, its error output is returned as 'import_error'.
+    """
+    import_times, import_error = [], None
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    for i in xrange(repeat):
+        process = subprocess.Popen([sys.executable, '-c', IMPORT_SCRIPT],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        output, error = process.communicate()
+        try:
+            if process.returncode != 0:
+                raise ValueError
+            import_times.append(float(output))
+        except ValueError:
+            import_error = error.strip() or 'exited with status %s' % process.returncode
+            break
+
+    template = Template("""{% load compress %}{% compress js %}
+    <script type="text/javascript">obj.value = "value";</script>
+    {% endcompress %}""")
+    debug, site_cache_keys = django_settings.DEBUG, settings.SITE_CACHE_KEYS
+    django_settings.DEBUG = settings.SITE_CACHE_KEYS = True
+    try:
+        clear_domains()
+        queries = []
+        for i in xrange(2):
+            reset_queries()
+            template.render(Context({}))
+            queries.append(len(connection.queries))
+    finally:
+        django_settings.DEBUG, settings.SITE_CACHE_KEYS = debug, site_cache_keys
+    results = {
+        'import': min(import_times or [None]),
+        'queries_cold': queries[0],
+        'queries_warm': queries[1],
+    }
+    if import_error:
+        results['import_error'] = import_error
+    return results
+
+IMPORT_SCRIPT = """
+import time
+start = time.time()
+import compressor.templatetags.compress
+print time.time() - start
+"""
+
+
+def generate_css(size, seed=0):
+    """
+    Returns about ``size`` bytes of stylesheet rules with comments, shorthand
+    properties and relative url() references, the same for a given seed.
+    """
+    rand = random.Random(seed)
+    rules = []
+    length = 0
+    while length < size:
+        i = len(rules)
+        rule = ("/* section %d */\n"
+                ".block-%d .element-%d, #id-%d > a:hover {\n"
+                "    margin: %dpx %dpx;\n"
+                "    color: #%06x;\n"
+                "    background: url(../img/sprite-%d.png) no-repeat %dpx 0;\n"
+                "    font: %dpx/1.4 \"Helvetica Neue\", Arial, sans-serif;\n"
+                "}\n" % (i, i, rand.randint(0, 99), i, rand.randint(0, 20), rand.randint(0, 20),
+                         rand.randint(0, 0xffffff), rand.randint(0, 9), -rand.randint(0, 40) * 16,
+                         rand.randint(10, 18)))
+        rules.append(rule)
+        length += len(rule)
+    return "".join(rules)
+
+
+def generate_js(size, seed=0):
+    """
+    Returns about ``size`` bytes of javascript functions with comments, string
+    literals and regular expressions, the same for a given seed.
+    """
+    rand = random.Random(seed)
+    functions = []
+    length = 0
+    while length < size:
+        i = len(functions)
+        function = ("// Handles widget %d\n"
+                    "function widget%d(element, options) {\n"
+                    "    var count = %d, label = \"widget-%d\";\n"
+                    "    if (/^item-\\d+$/.test(element.id)) {\n"
+                    "        count += options.step || %d;\n"
+                    "    }\n"
+                    "    /* keep the label in sync */\n"
+                    "    element.setAttribute('data-label', label + ':' + count);\n"
+                    "    return count;\n"
+                    "}\n" % (i, i, rand.randint(0, 1000), i, rand.randint(1, 9)))
+        functions.append(function)
+        length += len(function)
+    return "".join(functions)
+
+
+def generate_ccss(size, seed=0):
+    """
+    Returns about ``size`` bytes of CleverCSS with variables and nested rules,
+    the same for a given seed.
+    """
+    rand = random.Random(seed)
+    rules = ["base = #%06x\n\n" % rand.randint(0, 0xffffff)]
+    length = len(rules[0])
+    while length < size:
+        i = len(rules)
+        rule = (".block-%d:\n"
+                "    margin: %dpx\n"
+                "    color: $base\n"
+                "    a:\n"
+                "        color: #%06x\n"
+                "        padding: %dpx %dpx\n\n" % (i, rand.randint(0, 20), rand.randint(0, 0xffffff),
+                                                   rand.randint(0, 9), rand.randint(0, 9)))
+        rules.append(rule)
+        length += len(rule)
+    return "".join(rules)
+
+
+CORPORA = {
+    'css': (generate_css, CssCompressor, '.css',
+            '<link rel="stylesheet" href="%s" type="text/css">', '<style type="text/css">%s</style>'),
+    'js': (generate_js, JsCompressor, '.js',
+           '<script type="text/javascript" src="%s"></script>', '<script type="text/javascript">%s</script>'),
+    'ccss': (generate_ccss, CssCompressor, '.ccss',
+             '<link rel="stylesheet" href="%s" type="text/css">', None),
+}
+
+CORPUS_DIR = 'benchmark'
+
+
+def write_corpus(kind, size, files=4):
+    """
+    Writes ``files`` linked files totalling about ``size`` bytes of the given
+    kind to COMPRESS_ROOT and returns the compress block that includes them,
+    along with an inline hunk when the kind can have one.
+    """
+    generate, compressor_class, extension, link, inline = CORPORA[kind]
+    directory = os.path.join(settings.MEDIA_ROOT, CORPUS_DIR)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    html = []
+    for i in xrange(files):
+        name = '%s-%d-%d%s' % (kind, size, i, extension)
+        fd = open(os.path.join(directory, name), 'w')
+        fd.write(generate(size // files, seed=i))
+        fd.close()
+        html.append(link % "".join((settings.MEDIA_URL, CORPUS_DIR, '/', name)))
+    if inline:
+        html.append(inline % generate(1024, seed=files))
+    return "\n".join(html)
+
+
+def remove_corpora():
+    shutil.rmtree(os.path.join(settings.MEDIA_ROOT, CORPUS_DIR), True)
+
+
+def get_filters(kind):
+    """
+    Returns the name and class of each filter that can be timed on the given
+    kind of content, tried on a little generated content of that kind, and
+    a dict of the names of the ones that can't, such as CSSTidy and YUI
+    Compressor when their binaries don't run, with the reason.
+    """
+    names = {
+        'css': ['compressor.filters.css_default.CssAbsoluteFilter',
+                'compressor.filters.csstidy.CSSTidyFilter',
+                'compressor.filters.yui.YUICSSFilter'],
+        'js': ['compressor.filters.jsmin.JSMinFilter',
+               'compressor.filters.yui.YUIJSFilter'],
+    }[kind]
+    sample = {'css': generate_css, 'js': generate_js}[kind](512)
+    available, skipped = [], {}
+    for name in names:
+        try:
+            cls = get_class(name)
+            cls(sample, filter_type=kind).output(media_url=settings.MEDIA_URL)
+        except (FilterError, EnvironmentError), e:
+            skipped[name.split('.')[-1]] = str(e).strip() or e.__class__.__name__
+            continue
+        except NotImplementedError:
+            pass
+        available.append((name.split('.')[-1], cls))
+    return available, skipped
+
+
+def bench_pipeline(sizes=(16 * 1024, 128 * 1024, 1024 * 1024), repeat=5, number=3):
+    """
+    Times each stage of the pipeline on generated CSS, JS and, if a '.ccss'
+    compiler is configured, CleverCSS corpora of the given sizes: parsing the
+    block, split_contents, hunks, concat, every available filter, save_file
+    and rendering a compress tag with a cold and a warm cache.
+
+    The corpora are written to COMPRESS_ROOT/benchmark and bundles built from
+    them are deleted afterwards.
+    """
+    results = {}
+    compress = settings.COMPRESS
+    settings.COMPRESS = True
+    try:
+        for kind in ('css', 'js', 'ccss'):
+            if kind == 'ccss' and '.ccss' not in settings.COMPILER_FORMATS:
+                continue
+            results[kind] = {}
+            for size in sizes:
+                results[kind][str(size)] = bench_corpus(kind, size, repeat, number)
+    finally:
+        settings.COMPRESS = compress
+        remove_corpora()
+    return results
+
+
+def bench_corpus(kind, size, repeat, number):
+    compressor_class = CORPORA[kind][1]
+    filter_kind = compressor_class(u'').type
+    content = write_corpus(kind, size)
+    template = Template("{%% load compress %%}{%% compress %s %%}%s{%% endcompress %%}" % (filter_kind, content))
+    compressor = compressor_class(content)
+    compressor.split_contents()
+    compressor.hunks
+    concatenated = compressor.concat()
+
+    def split_contents():
+        compressor_class(content).split_contents()
+
+    def hunks():
+        compressor._hunks = None
+        compressor.hunks
+
+    def save_file():
+        compressor.save_file()
+
+    def delete_file():
+        if default_storage.exists(compressor.new_filepath):
+            default_storage.delete(compressor.new_filepath)
+
+    def clear():
+        if kind == 'ccss':
+            # make the compiler run again
+            for name in os.listdir(os.path.join(settings.MEDIA_ROOT, CORPUS_DIR)):
+                if name.startswith('ccss-%d-' % size) and name.endswith('.css'):
+                    os.remove(os.path.join(settings.MEDIA_ROOT, CORPUS_DIR, name))
+        cachekey = compressor_class(content).cachekey
+        cache.delete(cachekey)
+        cache.delete('django_css.in_progress.%s' % cachekey)
+        delete_file()
+
+    def render():
+        template.render(Context({}))
+
+    timings = {
+        'parse': best_of(lambda: compressor_class(content), repeat, number),
+        'split_contents': best_of(split_contents, repeat, number),
+        'hunks': best_of(hunks, repeat, number),
+        'concat': best_of(compressor.concat, repeat, number),
+        'filters': {},
+        'save_file': best_of(save_file, repeat, number, setup=delete_file),
+        'render_cold': best_of(render, repeat, number, setup=clear),
+        'render_warm': best_of(render, repeat, number),
+    }
+    filename = os.path.join(settings.MEDIA_ROOT, CORPUS_DIR, '%s-%d-0%s' % (kind, size, CORPORA[kind][2]))
+    available, timings['skipped_filters'] = get_filters(filter_kind)
+    for name, cls in available:
+        method = implements(cls, 'output') and 'output' or 'input'
+        filter = getattr(cls(concatenated, filter_type=filter_kind), method)
+        timings['filters'][name] = best_of(
+            lambda: filter(filename=filename, media_url=settings.MEDIA_URL), repeat, number)
+    clear()
+    return timings
+
+
+def measure(func, repeat=7, number=3, setup=None):
+    """
+    Times ``repeat`` runs of ``number`` calls to func and returns the min,
+    median and standard deviation of their averages, in seconds.
+    """
+    timings = sorted([best_of(func, 1, number, setup) for i in xrange(repeat)])
+    mean = sum(timings) / len(timings)
+    middle = len(timings) // 2
+    if len(timings) % 2:
+        median = timings[middle]
+    else:
+        median = (timings[middle - 1] + timings[middle]) / 2
+    return {
+        'min': timings[0],
+        'median': median,
+        'stdev': (sum([(t - mean) ** 2 for t in timings]) / len(timings)) ** 0.5,
+    }
+
+
+def case_jsmin(size=256 * 1024):
+    content = generate_js(size)
+    filter = get_class('compressor.filters.jsmin.JSMinFilter')(content, filter_type='js')
+    return None, filter.output, None
+
+
+def case_compressor(size=256 * 1024):
+    css, js = write_corpus('css', size), write_corpus('js', size)
+
+    def build():
+        CssCompressor(css).combined
+        JsCompressor(js).combined
+    return None, build, remove_corpora
+
+
+def case_templatetag(size=64 * 1024):
+    content = write_corpus('js', size)
+    template = Template("{%% load compress %%}{%% compress js %%}%s{%% endcompress %%}" % content)
+    compress = settings.COMPRESS
+    settings.COMPRESS = True
+
+    def clear():
+        compressor = JsCompressor(content)
+        cache.delete(compressor.cachekey)
+        cache.delete('django_css.in_progress.%s' % compressor.cachekey)
+        if default_storage.exists(compressor.new_filepath):
+            default_storage.delete(compressor.new_filepath)
+
+    def teardown():
+        clear()
+        settings.COMPRESS = compress
+        remove_corpora()
+    return clear, lambda: template.render(Context({})), teardown
+
+# Each case returns a (setup, func, teardown) tuple; func is what's measured
+# and setup, if any, runs before each call.
+REGRESSION_CASES = {
+    'jsmin': case_jsmin,
+    'compressor': case_compressor,
+    'templatetag': case_templatetag,
+}
+
+
+def run_case(name, repeat=7, number=3):
+    """
+    Returns the timings of a regression case and the peak memory, in KB,
+    one call to it takes on top of its setup in a fresh interpreter. If that
+    interpreter fails, its error output is returned as 'error' instead of
+    the peak memory.
+    """
+    setup, func, teardown = REGRESSION_CASES[name]()
+    try:
+        result = measure(func, repeat, number, setup)
+    finally:
+        if teardown is not None:
+            teardown()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    process = subprocess.Popen([sys.executable, '-c', MEMORY_SCRIPT, name],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    output, error = process.communicate()
+    try:
+        if process.returncode != 0:
+            raise ValueError
+        result['peak_memory'] = int(output.split()[-1])
+    except (ValueError, IndexError):
+        result['error'] = error.strip() or 'exited with status %s' % process.returncode
+    return result
+
+MEMORY_SCRIPT = """
+import resource, sys
+from compressor.benchmark import REGRESSION_CASES
+setup, func, teardown = REGRESSION_CASES[sys.argv[1]]()
+try:
+    if setup is not None:
+        setup()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func()
+    print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+finally:
+    if teardown is not None:
+        teardown()
+"""
+
+
+# Peak memory differences below this many KB are noise, not regressions.
+MEMORY_SLACK = 1024
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Returns a list of (case, measure, baseline, current) tuples for each
+    median timing or peak memory in results that is more than ``threshold``
+    above the baseline, or missing from results although the baseline has
+    it, with None as current.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for key in ('median', 'peak_memory'):
+            old, new = baseline[name].get(key), result.get(key)
+            if old is None:
+                continue
+            if new is None:
+                regressions.append((name, key, old, None))
+                continue
+            if key == 'peak_memory' and new - old < MEMORY_SLACK:
+                continue
+            if new > old * (1 + threshold):
+                regressions.append((name, key, old, new))
+    return regressions
+
+
+def peak_memory(func):
+    """
+    Calls func and returns the peak memory it allocated in KB, as traced by
+    tracemalloc where it is available. Otherwise it's the growth of the
+    process' maximum resident size, which only shows new peaks.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            func()
+            return tracemalloc.get_traced_memory()[1] // 1024
+        finally:
+            tracemalloc.stop()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+
+def profile_block(kind, content, limit=10, sort='cumulative'):
+    """
+    Runs a compress block through each stage of the pipeline under cProfile,
+    without the cache, and returns a dict with the time, peak memory and the
+    ``limit`` hottest functions of every stage.
+
+    Linked files in COMPILER_FORMATS are always compiled, even if they're up
+    to date, and the bundle is saved to a scratch directory, so every run
+    profiles the work a rebuild does and the real bundle is left alone.
+    """
+    class ProfiledCompressor({'css': CssCompressor, 'js': JsCompressor}[kind]):
+        recompile = staticmethod(lambda filename: True)
+    compressor_class = ProfiledCompressor
+    compressors = []
+    directory = tempfile.mkdtemp()
+    storage = compressor_module.default_storage
+
+    def save_file():
+        compressor_module.default_storage = FileSystemStorage(location=directory)
+        try:
+            return compressor().save_file()
+        finally:
+            compressor_module.default_storage = storage
+
+    def compressor():
+        return compressors[0]
+    stages = [
+        ('parse', lambda: compressors.append(compressor_class(content))),
+        ('split_contents', lambda: compressor().split_contents()),
+        ('cachekey', lambda: compressor().cachekey),
+    ]
+    if settings.STREAMING:
+        stages.append(('stream', lambda: compressor().stream()))
+    else:
+        stages.extend([
+            ('hunks', lambda: compressor().hunks),
+            ('output filters', lambda: compressor().combined),
+        ])
+    stages.extend([
+        ('hash', lambda: compressor().hash),
+        ('save_file', save_file),
+    ])
+
+    results = []
+    compress, cache_filter_output = settings.COMPRESS, settings.CACHE_FILTER_OUTPUT
+    settings.COMPRESS, settings.CACHE_FILTER_OUTPUT = True, False
+    try:
+        for name, func in stages:
+            profile = cProfile.Profile()
+            start = time.time()
+            memory = peak_memory(lambda: profile.runcall(func))
+            duration = time.time() - start
+            stream = StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats(sort).print_stats(limit)
+            results.append({'stage': name, 'time': duration, 'peak_memory': memory,
+                            'profile': stream.getvalue()})
+    finally:
+        settings.COMPRESS, settings.CACHE_FILTER_OUTPUT = compress, cache_filter_output
+        shutil.rmtree(directory, True)
+    return results
+
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    if not timings:
+        return None
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def get_backend(name):
+    """
+    Returns a fresh cache for 'locmem' or 'file', or the cache of any other
+    backend URI, along with a function that cleans up after it.
+    """
+    if name == 'locmem':
+        return get_cache('locmem://'), lambda: None
+    if name == 'file':
+        directory = tempfile.mkdtemp()
+        return get_cache('file://%s' % directory), lambda: shutil.rmtree(directory, True)
+    return get_cache(name), lambda: None
+
+
+def load_worker(templates, index, renders):
+    """
+    Renders the templates in turn, starting at the given index, and returns
+    the latency of each render.
+    """
+    latencies = []
+    for i in xrange(renders):
+        template = templates[(index + i) % len(templates)]
+        start = time.time()
+        template.render(Context({}))
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def run_load(workers, renders, blocks, mode='threads', backend='locmem', scenario='cold',
+             size=32 * 1024, churn_interval=0.05):
+    """
+    Has ``workers`` threads or processes render ``renders`` compress tags
+    each, spread over ``blocks`` different blocks, against a new cache of
+    the given backend, and returns the p50 and p99 render latency, the
+    number of builds per cache key and the total time spent waiting for
+    another worker's build.
+
+    The cold scenario starts with an empty cache; the churn scenario also
+    touches one of the linked files every ``churn_interval`` seconds, which
+    gives every block a new cache key. Locmem caches aren't shared between
+    processes, so with processes each one builds for itself.
+    """
+    content = write_corpus('js', size)
+    churned = os.path.join(settings.MEDIA_ROOT, CORPUS_DIR, 'js-%d-0.js' % size)
+    templates = [Template('{%% load compress %%}{%% compress js %%}%s'
+                          '<script type="text/javascript">var block = %d;</script>'
+                          '{%% endcompress %%}' % (content, i)) for i in xrange(blocks)]
+    output_dir = "/".join((settings.OUTPUT_DIR.strip('/'), 'js'))
+    existing = default_storage.exists(output_dir) and set(default_storage.listdir(output_dir)[1]) or set()
+    load_cache, cleanup = get_backend(backend)
+    old_cache, compress, shared = compress_module.cache, settings.COMPRESS, settings.SHARED_CACHE_PATH
+    compress_module.cache, settings.COMPRESS, settings.SHARED_CACHE_PATH = load_cache, True, None
+    stats.reset()
+    results = []
+    churning = threading.Event()
+
+    def churn():
+        mtime = os.path.getmtime(churned)
+        while not churning.isSet():
+            churning.wait(churn_interval)
+            mtime += 1
+            os.utime(churned, (mtime, mtime))
+
+    def thread_worker(index):
+        results.append((load_worker(templates, index, renders), None))
+
+    def process_worker(index, queue):
+        stats.reset()
+        latencies = load_worker(templates, index, renders)
+        queue.put((latencies, stats.get_stats()))
+
+    start = time.time()
+    try:
+        if scenario == 'churn':
+            churner = threading.Thread(target=churn)
+            churner.start()
+        if mode == 'processes':
+            queue = multiprocessing.Queue()
+            runners = [multiprocessing.Process(target=process_worker, args=(i, queue)) for i in xrange(workers)]
+        else:
+            runners = [threading.Thread(target=thread_worker, args=(i,)) for i in xrange(workers)]
+        for runner in runners:
+            runner.start()
+        if mode == 'processes':
+            results = [queue.get() for runner in runners]
+        for runner in runners:
+            runner.join()
+        elapsed = time.time() - start
+        if scenario == 'churn':
+            churning.set()
+            churner.join()
+    finally:
+        churning.set()
+        compress_module.cache, settings.COMPRESS, settings.SHARED_CACHE_PATH = old_cache, compress, shared
+        cleanup()
+        remove_corpora()
+        if default_storage.exists(output_dir):
+            for name in set(default_storage.listdir(output_dir)[1]) - existing:
+                default_storage.delete("/".join((output_dir, name)))
+
+    totals = stats.get_stats()
+    stats.reset()
+    for latencies, worker_stats in results:
+        if worker_stats is not None:
+            stats.add(totals, worker_stats)
+    latencies = []
+    for worker_latencies, worker_stats in results:
+        latencies.extend(worker_latencies)
+    counters = totals['kinds'].get('js', dict.fromkeys(stats.COUNTERS, 0))
+    builds = [bundle['builds'] for bundle in totals['bundles'].values()]
+    return {
+        'mode': mode,
+        'backend': backend,
+        'scenario': scenario,
+        'workers': workers,
+        'renders': len(latencies),
+        'blocks': blocks,
+        'elapsed': elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies),
+        'keys': len(builds),
+        'builds': counters['rebuilds'],
+        'max_builds_per_key': max(builds or [0]),
+        'waits': counters['waits'],
+        'wait_time': counters['wait_time'],
+    }
+
+
+def bench_dogpile(workers=8, renders=10, blocks=2, modes=('threads', 'processes'),
+                  backends=('locmem', 'file'), scenarios=('cold', 'churn')):
+    """
+    Runs run_load for every combination of the given modes, cache backends
+    and scenarios.
+    """
+    results = []
+    for mode in modes:
+        for backend in backends:
+            for scenario in scenarios:
+                results.append(run_load(workers, renders, blocks, mode, backend, scenario))
+    return results
+
+
+BENCHMARKS = {
+    'dogpile': bench_dogpile,
+    'pipeline': bench_pipeline,
+    'templatetag': bench_templatetag,
+    'transcoding': bench_transcoding,
+}
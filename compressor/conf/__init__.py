@@ -0,0 +1,19 @@
+class Snapshot(object):
+    """
+    A read-only copy of the compressor settings, with lists made tuples.
+    Each Compressor takes one when it's created, so a bundle is built with
+    one configuration even if the settings module changes meanwhile.
+    """
+    def __init__(self, module):
+        for name, value in vars(module).items():
+            if name.isupper():
+                if isinstance(value, list):
+                    value = tuple(value)
+                self.__dict__[name] = value
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings snapshots can't be changed")
+
+def get_snapshot():
+    from compressor.conf import settings
+    return Snapshot(settings)
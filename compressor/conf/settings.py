@@ -5,12 +5,60 @@ from django.conf import settings
 MEDIA_URL = getattr(settings, 'COMPRESS_URL', settings.MEDIA_URL)
 MEDIA_ROOT = getattr(settings, 'COMPRESS_ROOT', settings.MEDIA_ROOT)
 OUTPUT_DIR = getattr(settings, 'COMPRESS_OUTPUT_DIR', 'CACHE')
+# Number of two character directory levels bundles are nested in, e.g. with
+# 2 they go to CACHE/css/ab/cd/abcd....css
+OUTPUT_SHARD_DEPTH = getattr(settings, 'COMPRESS_OUTPUT_SHARD_DEPTH', 0)
 
 COMPRESS = getattr(settings, 'COMPRESS', not settings.DEBUG)
+# Bundles up to this many bytes are put inline instead of linked.
+INLINE_THRESHOLD = getattr(settings, 'COMPRESS_INLINE_THRESHOLD', 0)
 ABSOLUTE_CSS_URLS = getattr(settings, 'COMPRESS_ABSOLUTE_CSS_URLS', True)
 COMPRESS_CSS_FILTERS = list(getattr(settings, 'COMPRESS_CSS_FILTERS', []))
 COMPRESS_JS_FILTERS = list(getattr(settings, 'COMPRESS_JS_FILTERS', ['compressor.filters.jsmin.JSMinFilter']))
 COMPILER_FORMATS = getattr(settings, 'COMPILER_FORMATS', {})
+# Hosts that url() references in CSS are spread across, e.g. ['http://a.example.com']
+ASSET_HOSTS = list(getattr(settings, 'COMPRESS_ASSET_HOSTS', []))
+
+# Stream hunks through the output filters into a spooled temporary file
+# instead of building the whole bundle in memory.
+STREAMING = getattr(settings, 'COMPRESS_STREAMING', False)
+SPOOL_MAX_SIZE = getattr(settings, 'COMPRESS_SPOOL_MAX_SIZE', 1024 * 1024)
+
+# Linked files at least this big are read through mmap, in blocks.
+MMAP_THRESHOLD = getattr(settings, 'COMPRESS_MMAP_THRESHOLD', 256 * 1024)
+
+# Build cache keys and url() versions from file contents instead of mtimes,
+# so every node of a cluster agrees on them.
+CONTENT_CACHE_KEYS = getattr(settings, 'COMPRESS_CONTENT_CACHE_KEYS', False)
+
+# Cache output filter results by a digest of their input and the filter chain.
+CACHE_FILTER_OUTPUT = getattr(settings, 'COMPRESS_CACHE_FILTER_OUTPUT', False)
+FILTER_OUTPUT_TIMEOUT = getattr(settings, 'COMPRESS_FILTER_OUTPUT_TIMEOUT', 2591000)
+
+# Prefix cache keys with the current Site's domain, so each site builds and
+# caches its own bundles.
+SITE_CACHE_KEYS = getattr(settings, 'COMPRESS_SITE_CACHE_KEYS', False)
+
+# Dotted path to a class whose instance gets the duration of each stage of
+# building and rendering bundles, e.g. 'compressor.timing.StatsdCollector'.
+TIMING_COLLECTOR = getattr(settings, 'COMPRESS_TIMING_COLLECTOR', None)
+STATSD_HOST = getattr(settings, 'COMPRESS_STATSD_HOST', 'localhost')
+STATSD_PORT = getattr(settings, 'COMPRESS_STATSD_PORT', 8125)
+STATSD_PREFIX = getattr(settings, 'COMPRESS_STATSD_PREFIX', 'compressor')
+
+# Add the tag cache counters of each process to totals in the cache at most
+# every this many seconds, for the compress_stats command. 0 never does.
+STATS_FLUSH_INTERVAL = getattr(settings, 'COMPRESS_STATS_FLUSH_INTERVAL', 0)
+
+# Remember what the last cache keys of each compress block were made of, for
+# the compress_explain command.
+EXPLAIN_REBUILDS = getattr(settings, 'COMPRESS_EXPLAIN_REBUILDS', False)
+
+# A file mapped into memory by every process on the host, holding rendered
+# tags so they are found there before going to the cache. None turns it off.
+SHARED_CACHE_PATH = getattr(settings, 'COMPRESS_SHARED_CACHE_PATH', None)
+SHARED_CACHE_SLOTS = getattr(settings, 'COMPRESS_SHARED_CACHE_SLOTS', 1024)
+SHARED_CACHE_SLOT_SIZE = getattr(settings, 'COMPRESS_SHARED_CACHE_SLOT_SIZE', 4096)
 
 if ABSOLUTE_CSS_URLS and 'compressor.filters.css_default.CssAbsoluteFilter' not in COMPRESS_CSS_FILTERS:
     COMPRESS_CSS_FILTERS.insert(0, 'compressor.filters.css_default.CssAbsoluteFilter')
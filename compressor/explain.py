@@ -0,0 +1,77 @@
+"""
+Keeps, for each compress block, the components of its last few cache keys
+while COMPRESS_EXPLAIN_REBUILDS is on, so the compress_explain command can
+tell why a block keeps getting a new key: changed content, a file's mtime or
+digest, the media url, the COMPRESS setting or the domain.
+"""
+import time
+
+from django.core.cache import cache
+
+from compressor.utils import get_hexdigest
+
+EXPLAIN_KEY = 'django_compressor.explain'
+EXPLAIN_TIMEOUT = 2591000
+# Number of cache keys kept per block.
+HISTORY_LENGTH = 5
+
+def history_key(block):
+    return "%s.%s" % (EXPLAIN_KEY, get_hexdigest(block)[:12])
+
+def record(block, cachekey, components):
+    """
+    Adds cachekey and its components to the history of the given block,
+    unless it is the block's last key already. The content is only kept as
+    a digest and a length.
+    """
+    key = history_key(block)
+    history = cache.get(key) or []
+    if history and history[-1]['cachekey'] == cachekey:
+        return
+    values = []
+    for name, value in components:
+        if name == 'content':
+            value = '%s (%d characters)' % (get_hexdigest(value)[:12], len(value))
+        values.append((name, value))
+    history.append({'cachekey': cachekey, 'time': time.time(), 'components': values})
+    cache.set(key, history[-HISTORY_LENGTH:], EXPLAIN_TIMEOUT)
+    blocks = cache.get(EXPLAIN_KEY) or []
+    if block not in blocks:
+        blocks.append(block)
+        cache.set(EXPLAIN_KEY, blocks, EXPLAIN_TIMEOUT)
+
+def get_blocks():
+    return cache.get(EXPLAIN_KEY) or []
+
+def get_history(block):
+    return cache.get(history_key(block)) or []
+
+def diff(old, new):
+    """
+    Returns the (name, old value, new value) of each component that differs
+    between two history entries, with None for a file that was added or
+    removed.
+    """
+    old_values, new_values = dict(old['components']), dict(new['components'])
+    changes = []
+    for name, value in old['components']:
+        if new_values.get(name) != value:
+            changes.append((name, value, new_values.get(name)))
+    for name, value in new['components']:
+        if name not in old_values:
+            changes.append((name, None, value))
+    return changes
+
+def explain(block):
+    """
+    Returns a (old cachekey, new cachekey, changes) tuple for each pair of
+    consecutive keys of the given block.
+    """
+    history = get_history(block)
+    return [(old['cachekey'], new['cachekey'], diff(old, new))
+            for old, new in zip(history, history[1:])]
+
+def clear():
+    for block in get_blocks():
+        cache.delete(history_key(block))
+    cache.delete(EXPLAIN_KEY)
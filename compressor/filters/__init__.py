@@ -1,14 +1,41 @@
+import threading
+
+from django.utils.encoding import smart_str
+
+from compressor.utils import get_hexdigest
+
+
 class FilterBase(object):
+    # Set to True if one instance can filter many hunks in a row, with only
+    # its content attribute changing between calls.
+    reusable = False
+
     def __init__(self, content, filter_type=None, verbose=0):
         self.type = filter_type
         self.content = content
         self.verbose = verbose
 
+    @classmethod
+    def fingerprint(cls, filter_type):
+        """
+        Returns a string that changes whenever the settings the filter runs
+        with change, such as its command line, so that its cached output is
+        not reused under different settings.
+        """
+        return ''
+
     def input(self, **kwargs):
         raise NotImplementedError
     def output(self, **kwargs):
         raise NotImplementedError
-        
+    def output_stream(self, infile, outfile, **kwargs):
+        """
+        Filters ``infile`` into ``outfile`` chunk by chunk. Only used when
+        COMPRESS_STREAMING is on; filters that don't implement it get the
+        whole content through ``output`` instead.
+        """
+        raise NotImplementedError
+
 class FilterError(Exception):
     """
     This exception is raised when a filter fails
@@ -20,7 +47,9 @@ def get_class(class_string):
     Convert a string version of a function name to the callable object.
     """
 
-    if not hasattr(class_string, '__bases__'):
+    if hasattr(class_string, '__bases__'):
+        cls = class_string
+    else:
 
         try:
             class_string = class_string.encode('ascii')
@@ -32,6 +61,89 @@ def get_class(class_string):
 
     return cls
 
+def implements(cls, method):
+    """
+    Returns True if the filter class overrides the given FilterBase method.
+    """
+    return getattr(cls, method).im_func is not getattr(FilterBase, method).im_func
+
+class FilterPipeline(object):
+    """
+    A list of filters resolved to their classes once, and split by the
+    methods each one implements so that filters are only called for methods
+    they have.
+    """
+    def __init__(self, filter_list, filter_type=None):
+        self.filter_type = filter_type
+        self.classes = [get_class(f) for f in filter_list]
+        self.filters = {
+            'input': [cls for cls in self.classes if implements(cls, 'input')],
+            'output': [cls for cls in self.classes if implements(cls, 'output')],
+        }
+        self.input_filters = self.filters['input']
+        self.output_filters = self.filters['output']
+        self.stream_filters = [cls for cls in self.classes
+                               if implements(cls, 'output') or implements(cls, 'output_stream')]
+        self.local = threading.local()
+
+    def get_filter(self, cls, content):
+        """
+        Returns a filter instance for the given content, reusing the current
+        thread's instance of reusable filters.
+        """
+        if not cls.reusable:
+            return cls(content, filter_type=self.filter_type)
+        instances = getattr(self.local, 'instances', None)
+        if instances is None:
+            instances = self.local.instances = {}
+        filter = instances.get(cls)
+        if filter is None:
+            filter = instances[cls] = cls(content, filter_type=self.filter_type)
+        filter.content = content
+        return filter
+
+    def apply(self, content, method, **kwargs):
+        for cls in self.filters[method]:
+            try:
+                content = getattr(self.get_filter(cls, content), method)(**kwargs)
+            except NotImplementedError:
+                pass
+        # only filters that hand back unicode cost a transcode here
+        return smart_str(content)
+
+    def output_cachekey(self, digest, media_url, streaming=False):
+        """
+        Cache key for the output filters' result on content with the given
+        digest, with the filters' fingerprints. Streaming and string output
+        may run different filters.
+        """
+        classes = streaming and self.stream_filters or self.output_filters
+        names = ",".join(["%s.%s %s" % (cls.__module__, cls.__name__, cls.fingerprint(self.filter_type))
+                          for cls in classes])
+        key = get_hexdigest("%s|%s|%s|%s" % (self.filter_type, names, media_url, digest))
+        return "django_compressor.filtered.%s" % key[:24]
+
+    def apply_stream(self, cls, infile, outfile, **kwargs):
+        filter = self.get_filter(cls, None)
+        if implements(cls, 'output_stream'):
+            filter.output_stream(infile, outfile, **kwargs)
+        else:
+            filter.content = infile.read()
+            outfile.write(smart_str(filter.output(**kwargs)))
+
+_pipelines = {}
+
+def get_pipeline(filter_list, filter_type=None):
+    """
+    Returns the FilterPipeline for a list of filters, compiling it on first use.
+    """
+    key = (tuple(filter_list), filter_type)
+    pipeline = _pipelines.get(key)
+    if pipeline is None:
+        # threads racing here keep whichever pipeline was stored first
+        pipeline = _pipelines.setdefault(key, FilterPipeline(filter_list, filter_type))
+    return pipeline
+
 def get_mod_func(callback):
     """
     Converts 'django.views.news.stories.story_detail' to
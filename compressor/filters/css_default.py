@@ -4,13 +4,17 @@ import posixpath
 
 from compressor.filters import FilterBase, FilterError
 from compressor.conf import settings
-from compressor.utils import get_file_hash
+from compressor.utils import get_file_hash, get_hexdigest
 
 URL_PATTERN = re.compile(r'url\(([^\)]+)\)')
 
 
 class CssAbsoluteFilter(FilterBase):
-    def input(self, filename=None, media_url=None, **kwargs):
+    reusable = True
+
+    def input(self, filename=None, media_url=None, settings=settings, **kwargs):
+        # the settings of the Compressor running the filter
+        self.settings = settings
         media_url = media_url or settings.MEDIA_URL
         media_root = os.path.abspath(settings.MEDIA_ROOT)
         if filename is not None:
@@ -20,7 +24,7 @@ class CssAbsoluteFilter(FilterBase):
         self.media_path = filename[len(media_root):]
         self.media_path = self.media_path.lstrip('/')
         self.media_url = media_url.rstrip('/')
-        self.mtime = get_file_hash(filename)
+        self.mtime = get_file_hash(filename, settings)
         self.has_http = False
         if self.media_url.startswith('http://') or self.media_url.startswith('https://'):
             self.has_http = True
@@ -52,6 +56,19 @@ class CssAbsoluteFilter(FilterBase):
             return "url('%s')" % self.add_mtime(url)
         full_url = '/'.join([str(self.directory_name), url])
         full_url = posixpath.normpath(full_url)
-        if self.has_http:
+        if self.settings.ASSET_HOSTS:
+            full_url = self.shard(full_url)
+        elif self.has_http:
             full_url = "%s%s" % (self.protocol, full_url)
-        return "url('%s')" % self.add_mtime(full_url)
\ No newline at end of file
+        return "url('%s')" % self.add_mtime(full_url)
+
+    def shard(self, url):
+        """
+        Puts url on one of COMPRESS_ASSET_HOSTS, picked by a hash of its path
+        so that an asset always lands on the same host.
+        """
+        if self.has_http:
+            url = url[url.find('/'):]
+        hosts = self.settings.ASSET_HOSTS
+        host = hosts[int(get_hexdigest(url)[:8], 16) % len(hosts)]
+        return "%s%s" % (host.rstrip('/'), url)
\ No newline at end of file
@@ -5,10 +5,19 @@ from compressor.filters import FilterBase, FilterError
 BINARY = getattr(settings, 'CSSTIDY_BINARY', 'csstidy')
 ARGUMENTS = getattr(settings, 'CSSTIDY_ARGUMENTS', '--template=highest --silent=true')
 
+def get_command():
+    return '%s %s %s' % (BINARY, '-', ARGUMENTS)
+
 class CSSTidyFilter(FilterBase):
+    reusable = True
+
+    @classmethod
+    def fingerprint(cls, filter_type):
+        return get_command()
+
     def output(self, **kwargs):
 
-        command = '%s %s %s' % (BINARY, '-', ARGUMENTS)
+        command = get_command()
         
         p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
         p.stdin.write(self.content)
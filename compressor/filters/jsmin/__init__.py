@@ -1,6 +1,27 @@
-from compressor.filters.jsmin.jsmin import jsmin
+from compressor.filters.jsmin.jsmin import jsmin, JavascriptMinify
 from compressor.filters import FilterBase
 
 class JSMinFilter(FilterBase):
+    reusable = True
+
     def output(self, **kwargs):
-        return jsmin(self.content)
\ No newline at end of file
+        return jsmin(self.content)
+
+    def output_stream(self, infile, outfile, **kwargs):
+        JavascriptMinify().minify(infile, LeadingNewlineStripper(outfile))
+
+class LeadingNewlineStripper(object):
+    """
+    Drops the newline JavascriptMinify writes before the first token, the
+    same way ``jsmin`` does for strings.
+    """
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.started = False
+
+    def write(self, data):
+        if not self.started:
+            self.started = True
+            if data == '\n':
+                return
+        self.outfile.write(data)
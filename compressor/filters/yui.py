@@ -8,16 +8,23 @@ BINARY = getattr(settings, 'COMPRESS_YUI_BINARY', 'java -jar yuicompressor.jar')
 CSS_ARGUMENTS = getattr(settings, 'COMPRESS_YUI_CSS_ARGUMENTS', '')
 JS_ARGUMENTS = getattr(settings, 'COMPRESS_YUI_JS_ARGUMENTS', '')
 
+def get_command(type):
+    arguments = ''
+    if type == 'js':
+        arguments = JS_ARGUMENTS
+    if type == 'css':
+        arguments = CSS_ARGUMENTS
+    return '%s --type=%s %s' % (BINARY, type, arguments)
+
 class YUICompressorFilter(FilterBase):
+    reusable = True
+
+    @classmethod
+    def fingerprint(cls, filter_type):
+        return get_command(filter_type)
 
     def output(self, **kwargs):
-        arguments = ''
-        if self.type == 'js':
-            arguments = JS_ARGUMENTS
-        if self.type == 'css':
-            arguments = CSS_ARGUMENTS
-            
-        command = '%s --type=%s %s' % (BINARY, self.type, arguments)
+        command = get_command(self.type)
 
         if self.verbose:
             command += ' --verbose'
@@ -48,7 +55,15 @@ class YUICSSFilter(YUICompressorFilter):
         super(YUICSSFilter, self).__init__(*args, **kwargs)
         self.type = 'css'
 
+    @classmethod
+    def fingerprint(cls, filter_type):
+        return get_command('css')
+
 class YUIJSFilter(YUICompressorFilter):
     def __init__(self, *args, **kwargs):
         super(YUIJSFilter, self).__init__(*args, **kwargs)
-        self.type = 'js'
\ No newline at end of file
+        self.type = 'js'
+
+    @classmethod
+    def fingerprint(cls, filter_type):
+        return get_command('js')
\ No newline at end of file
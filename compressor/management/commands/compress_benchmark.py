@@ -0,0 +1,38 @@
+import inspect
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from compressor.benchmark import BENCHMARKS
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', action='store', dest='repeat', type='int', default=5, help='Number of timing runs per benchmark; the best one is reported.'),
+        make_option('--sizes', action='store', dest='sizes', help='Comma separated corpus sizes in bytes for the pipeline benchmark, e.g. 16384,1048576.'),
+        make_option('--output', action='store', dest='output', help='Write the results to this file instead of stdout.'),
+        )
+    help = 'Run the compressor benchmarks and print the results as JSON.'
+    args = '[benchmark ...]'
+
+    def handle(self, *args, **options):
+        names = args or sorted(BENCHMARKS.keys())
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError('Unknown benchmark "%s", choose from: %s' % (name, ', '.join(sorted(BENCHMARKS.keys()))))
+        kwargs = {'repeat': options.get('repeat', 5)}
+        if options.get('sizes'):
+            try:
+                kwargs['sizes'] = [int(size) for size in options['sizes'].split(',')]
+            except ValueError:
+                raise CommandError('--sizes must be a comma separated list of numbers')
+        results = {}
+        for name in names:
+            accepted = inspect.getargspec(BENCHMARKS[name])[0]
+            results[name] = BENCHMARKS[name](**dict([(k, v) for k, v in kwargs.items() if k in accepted]))
+        output = simplejson.dumps(results, indent=2, sort_keys=True)
+        if options.get('output'):
+            fd = open(options['output'], 'w')
+            fd.write(output)
+            fd.close()
+        else:
+            print output
@@ -0,0 +1,35 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+from compressor import explain
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--block', action='store', dest='block', help='Only explain the blocks whose name contains this.'),
+        make_option('--clear', action='store_true', dest='clear', default=False, help='Forget the recorded cache keys afterwards.'),
+        )
+    help = ('Explain why compress blocks got new cache keys, from the components of their last keys recorded '
+            'while COMPRESS_EXPLAIN_REBUILDS is on.')
+
+    def handle(self, *args, **options):
+        blocks = [block for block in explain.get_blocks()
+                  if not options.get('block') or options['block'] in block]
+        if not blocks:
+            print 'No cache keys recorded, is COMPRESS_EXPLAIN_REBUILDS on?'
+        for block in blocks:
+            history = explain.get_history(block)
+            print '%s: %d cache keys' % (block, len(history))
+            for entry, (old, new, changes) in zip(history[1:], explain.explain(block)):
+                print '    %s -> %s at %s' % (old, new, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time'])))
+                for name, old_value, new_value in changes:
+                    if old_value is None:
+                        print '        %s added' % name
+                    elif new_value is None:
+                        print '        %s removed' % name
+                    else:
+                        print '        %s changed from %s to %s' % (name, old_value, new_value)
+                if not changes:
+                    print '        no component changed, the key changed because of a different option'
+        if options.get('clear'):
+            explain.clear()
@@ -0,0 +1,118 @@
+import math
+import os
+import re
+import time
+from optparse import make_option
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from compressor.conf import settings
+from compressor.utils import (get_live_bundles, get_output_path, is_recording_live_bundles,
+    LIVE_BUNDLES_TIMEOUT)
+
+GRACE_DAYS = int(math.ceil(LIVE_BUNDLES_TIMEOUT / (24 * 60 * 60.0)))
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--manifest', action='append', dest='manifests', default=[], help='A JSON file listing bundles that must be kept, such as a precompression manifest. Can be given more than once.'),
+        make_option('--grace', action='store', dest='grace', type='float', default=GRACE_DAYS, help='Only delete files older than this many days (default: %d, as long as a compress tag stays cached).' % GRACE_DAYS),
+        make_option('--batch-size', action='store', dest='batch_size', type='int', default=500, help='Number of files to delete between progress reports (default: 500).'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False, help='Only list the files that would be deleted.'),
+        )
+    help = ('Delete the files in COMPRESS_OUTPUT_DIR that are not in use anymore. A file is in use if a manifest '
+            'lists it or if it was built recently enough for a cached tag to still link to it.')
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        dry_run = options.get('dry_run', False)
+        batch_size = max(1, options.get('batch_size', 500))
+        manifests = options.get('manifests', [])
+        output_dir = settings.OUTPUT_DIR.strip('/')
+        if not default_storage.exists(output_dir):
+            return
+        if not manifests and not is_recording_live_bundles():
+            raise CommandError('No bundles have been recorded as in use in the cache, which may have been '
+                               'cleared; pass --manifest to say which bundles to keep.')
+
+        listed = set()
+        for path in self.read_manifests(manifests):
+            listed.update(self.aliases(path))
+        cutoff = time.time() - options.get('grace', GRACE_DAYS) * 24 * 60 * 60
+
+        paths = list(self.walk(output_dir))
+        old = [path for path in paths if path not in listed and self.modified_time(path) < cutoff]
+        stale = []
+        for start in range(0, len(old), batch_size):
+            batch = old[start:start + batch_size]
+            aliases = dict([(path, self.aliases(path)) for path in batch])
+            live = set(get_live_bundles(sum(aliases.values(), [])))
+            stale.extend([path for path in batch if not live.intersection(aliases[path])])
+
+        if verbosity:
+            print '%d files in use, %d stale files.' % (len(paths) - len(stale), len(stale))
+        for start in range(0, len(stale), batch_size):
+            batch = stale[start:start + batch_size]
+            for path in batch:
+                if verbosity > 1:
+                    print '%s %s' % (dry_run and 'Would delete' or 'Deleting', path)
+                if not dry_run:
+                    default_storage.delete(path)
+            if verbosity and not dry_run:
+                print 'Deleted %d of %d files.' % (start + len(batch), len(stale))
+
+    def modified_time(self, path):
+        """
+        Returns the modification time of a file as a timestamp. Files on
+        storages that can't tell are never considered stale.
+        """
+        if hasattr(default_storage, 'modified_time'):
+            try:
+                return time.mktime(default_storage.modified_time(path).timetuple())
+            except (OSError, NotImplementedError):
+                pass
+        try:
+            # lstat, so that dangling symlinks left by compress_shard still
+            # have an age
+            return os.lstat(default_storage.path(path)).st_mtime
+        except NotImplementedError:
+            return time.time()
+
+    def read_manifests(self, manifests):
+        """
+        Returns every COMPRESS_OUTPUT_DIR path mentioned in the given JSON
+        files, whether they hold plain paths, urls or rendered tags.
+        """
+        pattern = re.compile(r'%s/[^"\'\s<>?]+' % re.escape(settings.OUTPUT_DIR.strip('/')))
+        paths = []
+        for manifest in manifests:
+            try:
+                fd = open(manifest)
+                data = simplejson.load(fd)
+                fd.close()
+            except (IOError, ValueError), e:
+                raise CommandError('Could not read manifest %s: %s' % (manifest, e))
+            if isinstance(data, dict):
+                data = data.values()
+            for value in data:
+                paths.extend(pattern.findall(unicode(value)))
+        return paths
+
+    def aliases(self, path):
+        """
+        Returns the flat and the sharded path of a bundle, so that the
+        symlinks compress_shard leaves behind are kept along with it.
+        """
+        parts = path.split('/')
+        if len(parts) < 3:
+            return [path]
+        prefix, filename = parts[1], parts[-1]
+        return [path, "/".join(parts[:2] + [filename]), get_output_path(prefix, filename)]
+
+    def walk(self, path):
+        dirs, files = default_storage.listdir(path)
+        for filename in files:
+            yield "/".join((path, filename))
+        for directory in dirs:
+            for filename in self.walk("/".join((path, directory))):
+                yield filename
@@ -0,0 +1,40 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from compressor.benchmark import bench_dogpile
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', action='store', dest='workers', type='int', default=8, help='Number of threads or processes rendering at once (default: 8).'),
+        make_option('--renders', action='store', dest='renders', type='int', default=10, help='Number of renders per worker (default: 10).'),
+        make_option('--blocks', action='store', dest='blocks', type='int', default=2, help='Number of different compress blocks the workers render (default: 2).'),
+        make_option('--mode', action='append', dest='modes', help='"threads" or "processes", can be given more than once (default: both).'),
+        make_option('--backend', action='append', dest='backends', help='"locmem", "file" or a cache backend URI, can be given more than once (default: locmem and file).'),
+        make_option('--scenario', action='append', dest='scenarios', help='"cold" or "churn", can be given more than once (default: both).'),
+        make_option('--output', action='store', dest='output', help='Write the results to this file instead of stdout.'),
+        )
+    help = ('Render compress tags from many threads or processes at once and report the p50 and p99 render '
+            'latency, the builds per cache key and the time spent waiting for other builds, as JSON.')
+
+    def handle(self, *args, **options):
+        modes = options.get('modes') or ['threads', 'processes']
+        scenarios = options.get('scenarios') or ['cold', 'churn']
+        for mode in modes:
+            if mode not in ('threads', 'processes'):
+                raise CommandError('Unknown mode "%s", choose from: threads, processes' % mode)
+        for scenario in scenarios:
+            if scenario not in ('cold', 'churn'):
+                raise CommandError('Unknown scenario "%s", choose from: cold, churn' % scenario)
+        results = bench_dogpile(workers=max(1, options.get('workers', 8)),
+                                renders=max(1, options.get('renders', 10)),
+                                blocks=max(1, options.get('blocks', 2)),
+                                modes=modes, scenarios=scenarios,
+                                backends=options.get('backends') or ['locmem', 'file'])
+        output = simplejson.dumps(results, indent=2, sort_keys=True)
+        if options.get('output'):
+            fd = open(options['output'], 'w')
+            fd.write(output)
+            fd.close()
+        else:
+            print output
@@ -0,0 +1,43 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.template import Context, Template, TemplateDoesNotExist, TemplateSyntaxError
+from django.template.loader import get_template
+
+from compressor.benchmark import profile_block
+from compressor.conf import settings
+from compressor.templatetags.compress import CompressorNode
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--snippet', action='store', dest='snippet', help='Profile the compress blocks of this template code instead of a template file.'),
+        make_option('--limit', action='store', dest='limit', type='int', default=10, help='Number of functions to list per stage (default: 10).'),
+        make_option('--sort', action='store', dest='sort', default='cumulative', help='pstats sort key for the functions (default: cumulative).'),
+        )
+    help = ('Run the compress blocks of a template through the compressor under cProfile, bypassing the cache, '
+            'and print the time, peak memory and hottest functions of each stage.')
+    args = '[template name]'
+
+    def handle(self, *args, **options):
+        snippet = options.get('snippet')
+        if not snippet and len(args) != 1:
+            raise CommandError('Give a template name or --snippet.')
+        try:
+            if snippet:
+                template = Template(snippet)
+            else:
+                template = get_template(args[0])
+        except (TemplateDoesNotExist, TemplateSyntaxError), e:
+            raise CommandError('Could not load the template: %s' % e)
+
+        nodes = template.nodelist.get_nodes_by_type(CompressorNode)
+        if not nodes:
+            raise CommandError('The template has no compress blocks.')
+        context = Context({'MEDIA_URL': settings.MEDIA_URL})
+        for i, node in enumerate(nodes):
+            content = node.nodelist.render(context)
+            print '=' * 70
+            print 'Block %d of %d (%s)' % (i + 1, len(nodes), node.kind)
+            for result in profile_block(node.kind, content, options.get('limit', 10), options.get('sort', 'cumulative')):
+                print '-' * 70
+                print '%s: %.4fs, peak memory %d KB' % (result['stage'], result['time'], result['peak_memory'])
+                print result['profile']
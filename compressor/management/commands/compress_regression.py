@@ -0,0 +1,56 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from compressor.benchmark import REGRESSION_CASES, compare, run_case
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--baseline', action='store', dest='baseline', help='The JSON file holding the baseline results.'),
+        make_option('--save', action='store_true', dest='save', default=False, help='Write the results to the baseline file instead of comparing them.'),
+        make_option('--threshold', action='store', dest='threshold', type='float', default=0.2, help='Fail when a median timing or peak memory is more than this fraction above the baseline (default: 0.2).'),
+        make_option('--repeat', action='store', dest='repeat', type='int', default=7, help='Number of timing runs per case; their median is compared (default: 7).'),
+        )
+    help = ('Time the jsmin filter, the Compressor pipeline and the compress tag and fail when they got slower '
+            'or use more memory than in a baseline file.')
+    args = '[case ...]'
+
+    def handle(self, *args, **options):
+        baseline_file = options.get('baseline')
+        if not baseline_file:
+            raise CommandError('Give the baseline file with --baseline.')
+        names = args or sorted(REGRESSION_CASES.keys())
+        for name in names:
+            if name not in REGRESSION_CASES:
+                raise CommandError('Unknown case "%s", choose from: %s' % (name, ', '.join(sorted(REGRESSION_CASES.keys()))))
+        verbosity = int(options.get('verbosity', 1))
+        results = {}
+        for name in names:
+            results[name] = run_case(name, repeat=max(1, options.get('repeat', 7)))
+        failed = [name for name in names if 'error' in results[name]]
+        if failed:
+            raise CommandError('\n'.join(['Could not measure the peak memory of %s: %s'
+                                          % (name, results[name]['error']) for name in failed]))
+
+        if options.get('save'):
+            fd = open(baseline_file, 'w')
+            fd.write(simplejson.dumps(results, indent=2, sort_keys=True))
+            fd.close()
+            return
+        try:
+            fd = open(baseline_file)
+            baseline = simplejson.load(fd)
+            fd.close()
+        except (IOError, ValueError), e:
+            raise CommandError('Could not read baseline %s: %s' % (baseline_file, e))
+
+        if verbosity:
+            for name in names:
+                old = baseline.get(name, {})
+                print '%s: median %.6fs (baseline %s), peak memory %s KB (baseline %s)' % (
+                    name, results[name]['median'], old.get('median', '-'),
+                    results[name].get('peak_memory', '-'), old.get('peak_memory', '-'))
+        regressions = compare(results, baseline, options.get('threshold', 0.2))
+        if regressions:
+            raise CommandError('\n'.join(['%s %s regressed from %s to %s' % regression
+                                          for regression in regressions]))
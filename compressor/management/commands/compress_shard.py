@@ -0,0 +1,60 @@
+import os
+from optparse import make_option
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from compressor.conf import settings
+from compressor.utils import get_output_path
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False, help='Only list the files that would be moved.'),
+        make_option('--delete', action='store_true', dest='delete', default=False, help='Delete the old files when the storage backend can not link them, breaking their urls.'),
+        )
+    help = ('Move the files in COMPRESS_OUTPUT_DIR into the layout set by COMPRESS_OUTPUT_SHARD_DEPTH. '
+            'On local storage the old paths are replaced by symlinks so that their urls keep working, '
+            'elsewhere the old files are kept unless --delete is given.')
+
+    def handle(self, *args, **options):
+        if not settings.OUTPUT_SHARD_DEPTH:
+            raise CommandError('COMPRESS_OUTPUT_SHARD_DEPTH is not set.')
+        verbosity = int(options.get('verbosity', 1))
+        dry_run = options.get('dry_run', False)
+        output_dir = settings.OUTPUT_DIR.strip('/')
+        if not default_storage.exists(output_dir):
+            return
+        moved = 0
+        for prefix in default_storage.listdir(output_dir)[0]:
+            for filename in default_storage.listdir("/".join((output_dir, prefix)))[1]:
+                old_path = "/".join((output_dir, prefix, filename))
+                new_path = get_output_path(prefix, filename)
+                if self.is_link(old_path):
+                    continue
+                if verbosity > 1:
+                    print 'Moving %s to %s' % (old_path, new_path)
+                moved += 1
+                if not dry_run:
+                    self.move(old_path, new_path, options.get('delete', False))
+        if verbosity:
+            print '%s %s files.' % (dry_run and 'Would move' or 'Moved', moved)
+
+    def is_link(self, path):
+        try:
+            return os.path.islink(default_storage.path(path))
+        except NotImplementedError:
+            return False
+
+    def move(self, old_path, new_path, delete):
+        if not default_storage.exists(new_path):
+            fd = default_storage.open(old_path)
+            default_storage.save(new_path, fd)
+            fd.close()
+        try:
+            old_filename = default_storage.path(old_path)
+            new_filename = default_storage.path(new_path)
+        except NotImplementedError:
+            if delete:
+                default_storage.delete(old_path)
+            return
+        os.remove(old_filename)
+        os.symlink(os.path.relpath(new_filename, os.path.dirname(old_filename)), old_filename)
@@ -0,0 +1,39 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+from compressor import stats
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', action='store', dest='limit', type='int', default=10, help='Number of slowest bundles to list (default: 10).'),
+        make_option('--reset', action='store_true', dest='reset', default=False, help='Clear the totals after reporting them.'),
+        )
+    help = ('Report the hit ratio of the compress tag cache, the dogpile waits and rebuilds per bundle kind, and '
+            'the slowest bundles to build, from the totals processes flush to the cache (see '
+            'COMPRESS_STATS_FLUSH_INTERVAL).')
+
+    def handle(self, *args, **options):
+        totals = stats.get_totals()
+        if not totals['kinds']:
+            print 'No statistics in the cache yet.'
+            return
+        for kind, counters in sorted(totals['kinds'].items()):
+            lookups = counters['hits'] + counters['misses']
+            print '%s: %d lookups, %.1f%% hits, %d misses, %d rebuilds, %d bytes built' % (
+                kind, lookups, lookups and 100.0 * counters['hits'] / lookups or 0,
+                counters['misses'], counters['rebuilds'], counters['bytes'])
+            if counters.get('shared_hits'):
+                print '    %d hits from the shared memory cache' % counters['shared_hits']
+            if counters['waits']:
+                print '    %d dogpile waits, %.3fs on average' % (
+                    counters['waits'], counters['wait_time'] / counters['waits'])
+        slowest = sorted(totals['bundles'].items(), key=lambda item: item[1]['max_build_time'], reverse=True)
+        if slowest:
+            print
+            print 'Slowest bundles:'
+            for cachekey, bundle in slowest[:options.get('limit', 10)]:
+                print '    %.3fs  %s (%s, %d builds, %.3fs on average, %d bytes)' % (
+                    bundle['max_build_time'], cachekey, bundle['kind'], bundle['builds'],
+                    bundle['build_time'] / bundle['builds'], bundle['bytes'])
+        if options.get('reset'):
+            stats.clear_totals()
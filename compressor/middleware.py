@@ -0,0 +1,40 @@
+from compressor.templatetags.compress import (start_merging, finish_merging,
+    start_preloading, finish_preloading)
+
+
+class MergeBundlesMiddleware(object):
+    """
+    Collects the ``{% compress <js/css> merge %}`` blocks rendered for a
+    response and puts a single bundle per kind where ``{% compress_merged %}``
+    was used.
+    """
+    def process_request(self, request):
+        start_merging()
+
+    def process_response(self, request, response):
+        if response.get('Content-Type', '').startswith('text/html'):
+            response.content = finish_merging(response.content)
+        else:
+            finish_merging('')
+        return response
+
+
+class PreloadMiddleware(object):
+    """
+    Adds a ``Link: <url>; rel=preload`` header for every bundle linked by the
+    compress tags of a response, so browsers can start fetching them before
+    they get to the tags. Goes before MergeBundlesMiddleware, if used.
+    """
+    kinds = {'css': 'style', 'js': 'script'}
+
+    def process_request(self, request):
+        start_preloading()
+
+    def process_response(self, request, response):
+        links = ['<%s>; rel=preload; as=%s' % (url, self.kinds[kind])
+                 for kind, url in finish_preloading()]
+        if links:
+            if response.has_header('Link'):
+                links.insert(0, response['Link'])
+            response['Link'] = ', '.join(links)
+        return response
@@ -0,0 +1,7 @@
+from django.contrib.sites.models import Site
+from django.db.models.signals import post_save, post_delete
+
+from compressor.utils import clear_domains
+
+post_save.connect(clear_domains, sender=Site, dispatch_uid='compressor.clear_domains')
+post_delete.connect(clear_domains, sender=Site, dispatch_uid='compressor.clear_domains')
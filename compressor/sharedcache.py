@@ -0,0 +1,163 @@
+"""
+A fixed-size hash table in a memory mapped file, which every worker process
+on a host maps, so a tag rendered by one of them is found by the others
+without a round trip to the network cache. See COMPRESS_SHARED_CACHE_PATH.
+Only imported when that is set, as it needs fcntl and a shared mmap.
+
+Each slot starts with a sequence number that writers make odd while they
+change the slot and even again when they are done, so readers never lock:
+they retry when the number was odd or changed while they read. Writers take
+an exclusive flock on the file. A key is looked for in PROBES slots after
+the one its digest points to; when they're all taken, the least recently
+read one is replaced. The file is created at its full size and never
+resized, as that would crash the other processes that have it mapped.
+"""
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor
+
+MAGIC = 'DCSSSHM1'
+# magic, number of slots, slot size
+HEADER = struct.Struct('=8sII')
+# sequence number, key digest, time stored, time last read, value length
+SLOT = struct.Struct('=I20sddI')
+ACCESSED_OFFSET = 4 + 20 + 8
+PROBES = 8
+RETRIES = 3
+
+
+class SharedCache(object):
+
+    def __init__(self, path, slots=1024, slot_size=4096, timeout=2591000):
+        # the number and size of the slots are part of the file name, so
+        # processes set up differently never map, let alone resize, the
+        # same file
+        self.path = '%s.%d.%d' % (path, slots, slot_size)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.size = HEADER.size + slots * slot_size
+        self.header = HEADER.pack(MAGIC, slots, slot_size)
+        if not os.path.exists(self.path):
+            self.create()
+        self.fd = os.open(self.path, os.O_RDWR)
+        if os.fstat(self.fd).st_size < self.size or os.read(self.fd, HEADER.size) != self.header:
+            os.close(self.fd)
+            raise ImproperlyConfigured('%s is not a shared cache of %d slots of %d bytes.' % (self.path, slots, slot_size))
+        self.map = mmap.mmap(self.fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def create(self):
+        """
+        Creates the file under a temporary name and links it into place, so
+        no process maps it before it has its full size and header.
+        """
+        fd, temp = tempfile.mkstemp(prefix=os.path.basename(self.path), dir=os.path.dirname(self.path) or '.')
+        try:
+            os.fchmod(fd, 0644)
+            os.ftruncate(fd, self.size)
+            os.write(fd, self.header)
+            try:
+                os.link(temp, self.path)
+            except OSError, e:
+                # another process created it first
+                if e.errno != errno.EEXIST:
+                    raise
+        finally:
+            os.close(fd)
+            os.unlink(temp)
+
+    def offsets(self, digest):
+        bucket = struct.unpack('=I', digest[:4])[0] % self.slots
+        return [HEADER.size + ((bucket + i) % self.slots) * self.slot_size
+                for i in xrange(min(PROBES, self.slots))]
+
+    def get(self, key):
+        """
+        Returns the value stored for key as unicode, or None.
+        """
+        if self.map[:HEADER.size] != self.header:
+            return None
+        digest = sha_constructor(smart_str(key)).digest()
+        for offset in self.offsets(digest):
+            for attempt in xrange(RETRIES):
+                seq, slot_digest, stored, accessed, length = SLOT.unpack_from(self.map, offset)
+                if seq & 1:
+                    continue
+                if slot_digest != digest:
+                    break
+                start = offset + SLOT.size
+                value = self.map[start:start + length]
+                if struct.unpack_from('=I', self.map, offset)[0] != seq:
+                    continue
+                now = time.time()
+                if stored + self.timeout < now:
+                    return None
+                # only used to pick what to evict, so it's not worth a lock
+                struct.pack_into('=d', self.map, offset + ACCESSED_OFFSET, now)
+                return value.decode('utf-8')
+            else:
+                # kept changing under us, leave it to the network cache
+                return None
+        return None
+
+    def set(self, key, value, timeout=None):
+        """
+        Stores value for key, for timeout seconds if given and shorter than
+        the cache's own. Returns False if it doesn't fit in a slot.
+        """
+        digest = sha_constructor(smart_str(key)).digest()
+        data = smart_str(value)
+        if len(data) > self.slot_size - SLOT.size:
+            return False
+        self.lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            target = None
+            oldest = None
+            for offset in self.offsets(digest):
+                seq, slot_digest, stored, accessed, length = SLOT.unpack_from(self.map, offset)
+                if slot_digest == digest or not stored:
+                    target = offset
+                    break
+                if oldest is None or accessed < oldest[0]:
+                    oldest = (accessed, offset)
+            if target is None:
+                target = oldest[1]
+            seq = struct.unpack_from('=I', self.map, target)[0]
+            now = time.time()
+            # a shorter timeout is kept as an earlier time stored
+            stored = now - max(0, self.timeout - (timeout or self.timeout))
+            struct.pack_into('=I', self.map, target, (seq + 1) & 0xffffffff)
+            SLOT.pack_into(self.map, target, (seq + 1) & 0xffffffff, digest, stored, now, len(data))
+            self.map[target + SLOT.size:target + SLOT.size + len(data)] = data
+            struct.pack_into('=I', self.map, target, (seq + 2) & 0xffffffff)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.lock.release()
+        return True
+
+    def clear(self):
+        self.lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            for i in xrange(self.slots):
+                offset = HEADER.size + i * self.slot_size
+                seq = struct.unpack_from('=I', self.map, offset)[0]
+                SLOT.pack_into(self.map, offset, (seq + 2) & 0xffffffff, '\0' * 20, 0, 0, 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.lock.release()
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent after each timed stage of building or rendering a bundle, see
+# compressor.timing. ``kind`` is 'css' or 'js' and ``duration`` is in seconds.
+stage_timed = Signal(providing_args=['stage', 'kind', 'duration'])
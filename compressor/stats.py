@@ -0,0 +1,121 @@
+"""
+Counters of how the rendered tag cache does, per bundle kind: hits and how
+many of them the shared memory cache served, misses, dogpile waits and the
+time spent waiting, rebuilds and the bytes they produced, along with the
+slowest bundles to build.
+
+They are kept per process. With COMPRESS_STATS_FLUSH_INTERVAL set, they are
+added to the totals in the cache at most that often, which is where the
+compress_stats command reads them from.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+
+from compressor.conf import settings
+
+STATS_KEY = 'django_compressor.stats'
+STATS_TIMEOUT = 2591000
+COUNTERS = ('hits', 'shared_hits', 'misses', 'waits', 'wait_time', 'rebuilds', 'bytes')
+# Number of bundles whose build times are kept, the slowest ones win.
+MAX_BUNDLES = 100
+
+_lock = threading.Lock()
+_stats = {'kinds': {}, 'bundles': {}}
+_last_flush = [time.time()]
+
+def empty():
+    return {'kinds': {}, 'bundles': {}}
+
+def add(totals, stats):
+    """
+    Adds the counters and bundle build times of stats to totals.
+    """
+    for kind, counters in stats['kinds'].items():
+        kind_totals = totals['kinds'].setdefault(kind, dict.fromkeys(COUNTERS, 0))
+        for name, value in counters.items():
+            kind_totals[name] = kind_totals.get(name, 0) + value
+    for cachekey, bundle in stats['bundles'].items():
+        total = totals['bundles'].get(cachekey)
+        if total is None:
+            totals['bundles'][cachekey] = dict(bundle)
+        else:
+            total['builds'] += bundle['builds']
+            total['build_time'] += bundle['build_time']
+            total['max_build_time'] = max(total['max_build_time'], bundle['max_build_time'])
+            total['bytes'] = bundle['bytes']
+    if len(totals['bundles']) > MAX_BUNDLES:
+        slowest = sorted(totals['bundles'].items(), key=lambda item: item[1]['max_build_time'], reverse=True)
+        totals['bundles'] = dict(slowest[:MAX_BUNDLES])
+    return totals
+
+def incr(kind, name, value=1):
+    _lock.acquire()
+    try:
+        counters = _stats['kinds'].setdefault(kind, dict.fromkeys(COUNTERS, 0))
+        counters[name] += value
+    finally:
+        _lock.release()
+    maybe_flush()
+
+def record_build(kind, cachekey, duration, size):
+    """
+    Counts a rebuild of the bundle with the given cache key, which took
+    duration seconds and produced size bytes.
+    """
+    bundle = {'kind': kind, 'builds': 1, 'build_time': duration,
+              'max_build_time': duration, 'bytes': size}
+    _lock.acquire()
+    try:
+        counters = _stats['kinds'].setdefault(kind, dict.fromkeys(COUNTERS, 0))
+        counters['rebuilds'] += 1
+        counters['bytes'] += size
+        add(_stats, {'kinds': {}, 'bundles': {cachekey: bundle}})
+    finally:
+        _lock.release()
+    maybe_flush()
+
+def get_stats():
+    """
+    Returns a copy of this process' counters since they were last flushed.
+    """
+    _lock.acquire()
+    try:
+        return add(empty(), _stats)
+    finally:
+        _lock.release()
+
+def reset():
+    _lock.acquire()
+    try:
+        _stats.update(empty())
+    finally:
+        _lock.release()
+
+def maybe_flush():
+    interval = settings.STATS_FLUSH_INTERVAL
+    if interval and time.time() - _last_flush[0] >= interval:
+        flush()
+
+def flush():
+    """
+    Adds this process' counters to the totals in the cache and starts
+    counting from zero. Processes flushing at the same moment may lose
+    each other's counts, the totals are only meant as a trend.
+    """
+    _lock.acquire()
+    try:
+        stats = add(empty(), _stats)
+        _stats.update(empty())
+        _last_flush[0] = time.time()
+    finally:
+        _lock.release()
+    totals = cache.get(STATS_KEY) or empty()
+    cache.set(STATS_KEY, add(totals, stats), STATS_TIMEOUT)
+
+def get_totals():
+    return cache.get(STATS_KEY) or empty()
+
+def clear_totals():
+    cache.delete(STATS_KEY)
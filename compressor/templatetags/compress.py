@@ -1,50 +1,322 @@
+import os
+import re
+import threading
+import time
+
 from django import template
 from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.safestring import mark_safe
 
-try:
-    from django.contrib.sites.models import Site
-    DOMAIN = Site.objects.get_current().domain
-except:
-    DOMAIN = ''
-    
-from compressor import CssCompressor, JsCompressor
+from compressor import BuildError, CssCompressor, JsCompressor, explain, stats, timing
 from compressor.conf import settings
+from compressor.utils import get_hexdigest
 from time import sleep
 
 register = template.Library()
 
+def rewrite_media_url(html, old, new):
+    """
+    Points href and src attributes that start with one media url at another.
+    """
+    pattern = re.compile(r"""((?:href|src)\s*=\s*["']?)%s""" % re.escape(old))
+    return pattern.sub(lambda match: match.group(1) + new, html)
+
+COMPRESSORS = {
+    'css': CssCompressor,
+    'js': JsCompressor,
+}
+
+STYLE_END_PATTERN = re.compile(r'</(style)', re.I)
+
+@register.filter
+def escape_script(value):
+    """
+    Escapes every </ in inline JavaScript, so a string like "</script>" can't
+    end the <script> tag it's put in.
+    """
+    return mark_safe(value.replace('</', '<\\/'))
+
+@register.filter
+def escape_style(value):
+    """
+    Escapes </style in inline CSS, so it can't end the <style> tag it's put in.
+    """
+    return mark_safe(STYLE_END_PATTERN.sub(r'<\\/\1', value))
+
+# how long compress tags waiting for a build that failed give up at once
+# rather than all building again
+FAILED_TIMEOUT = 10
+# how many times a compress tag tries to become the one building its bundle
+BUILD_ATTEMPTS = 3
+
+MERGED_PLACEHOLDER = '<!-- compress_merged %s%s -->'
+
+_merging = threading.local()
+
+def start_merging():
+    """
+    Starts collecting the contents of ``merge`` compress blocks rendered by
+    this thread, see MergeBundlesMiddleware.
+    """
+    _merging.blocks = {'css': [], 'js': []}
+
+def is_merging():
+    return getattr(_merging, 'blocks', None) is not None
+
+def finish_merging(html):
+    """
+    Replaces the compress_merged placeholders in html with one bundle per kind
+    and stops collecting blocks. Bundles without a placeholder go before
+    </body>, or at the end of html if it has none.
+    """
+    blocks = getattr(_merging, 'blocks', None)
+    _merging.blocks = None
+    if not blocks:
+        return html
+    for kind in ('css', 'js'):
+        contents = [block[0] for block in blocks[kind]]
+        media_url = contents and blocks[kind][0][1]
+        for xhtml in (False, True):
+            placeholder = MERGED_PLACEHOLDER % (kind, xhtml and ' xhtml' or '')
+            if placeholder not in html:
+                continue
+            output = ''
+            if contents:
+                output = smart_str(render_merged(kind, contents, xhtml, media_url))
+                contents = []
+            html = html.replace(placeholder, output, 1).replace(placeholder, '')
+        if contents:
+            output = smart_str(render_merged(kind, contents, False, media_url))
+            if '</body>' in html:
+                html = html.replace('</body>', '%s</body>' % output, 1)
+            else:
+                html += output
+    return html
+
+PRELOAD_PATTERN = re.compile(r"""<(?:link|script)\s[^>]*(?:href|src)=["']([^"']+)["']""")
+
+_preloading = threading.local()
+
+def start_preloading():
+    """
+    Starts collecting the bundle urls rendered by this thread, see
+    PreloadMiddleware.
+    """
+    _preloading.urls = []
+
+def add_preloads(kind, html):
+    urls = getattr(_preloading, 'urls', None)
+    if urls is not None:
+        for url in PRELOAD_PATTERN.findall(html):
+            if (kind, url) not in urls:
+                urls.append((kind, url))
+
+def finish_preloading():
+    """
+    Returns the (kind, url) pairs of the bundles rendered since
+    start_preloading and stops collecting them.
+    """
+    urls = getattr(_preloading, 'urls', None) or []
+    _preloading.urls = None
+    return urls
+
+def render_merged(kind, contents, xhtml, media_url):
+    """
+    Renders a single bundle for the contents of several compress blocks,
+    cached by the ordered cache keys of the blocks.
+    """
+    compressor_class = COMPRESSORS[kind]
+    cachekeys = [compressor_class(content, xhtml=xhtml).cachekey for content in contents]
+    cachekey = "django_compressor.merged.%s.%s" % (get_hexdigest(".".join(cachekeys))[:12], xhtml)
+    # parsing everything again is only worth it when the bundle is built
+    output = render_cached(lambda: compressor_class("\n".join(contents), xhtml=xhtml), cachekey, kind=kind)
+    if media_url and media_url != settings.MEDIA_URL:
+        output = rewrite_media_url(output, settings.MEDIA_URL, media_url)
+    add_preloads(kind, output)
+    return output
+
+# how long a tag copied from the cache is kept in the shared memory cache:
+# it may be about to expire there, and compress_gc only waits a little
+# longer than that before it deletes the bundle the tag links to
+SHARED_COPY_TIMEOUT = 600
+
+_shared_caches = {}
+
+def get_shared_cache():
+    """
+    Returns this process' SharedCache for COMPRESS_SHARED_CACHE_PATH, or None
+    if it isn't set. Forked processes open their own, since flock doesn't
+    keep apart processes that share a file descriptor.
+    """
+    path = settings.SHARED_CACHE_PATH
+    if not path:
+        return None
+    key = (path, os.getpid())
+    shared = _shared_caches.get(key)
+    if shared is None:
+        # needs fcntl and a shared mmap, so not imported unless it's used
+        from compressor.sharedcache import SharedCache
+        shared = _shared_caches[key] = SharedCache(path, settings.SHARED_CACHE_SLOTS,
+                                                   settings.SHARED_CACHE_SLOT_SIZE)
+    return shared
+
+def build(compressor, cachekey, inline=False, kind=None):
+    kind = kind or compressor.type
+    started = time.time()
+    stop = timing.start('build', kind)
+    if callable(compressor):
+        compressor = compressor()
+    output = compressor.output(inline=inline)
+    stop()
+    cache.set(cachekey, output, 2591000) # rebuilds the cache every 30 days if nothing has changed.
+    size = compressor.settings.COMPRESS and compressor.size or 0
+    stats.record_build(kind, cachekey, time.time() - started, size)
+    return output
+
+def render_cached(compressor, cachekey, inline=False, kind=None):
+    """
+    Returns the rendered tag for cachekey from the caches, or builds it.
+    compressor can also be a function that returns one, which is only called
+    when the tag has to be built; kind must then be given.
+    """
+    kind = kind or compressor.type
+    shared = get_shared_cache()
+    if shared is not None:
+        in_cache = shared.get(cachekey)
+        if in_cache:
+            stats.incr(kind, 'hits')
+            stats.incr(kind, 'shared_hits')
+            return in_cache
+    in_cache = cache.get(cachekey)
+    if in_cache:
+        stats.incr(kind, 'hits')
+        if shared is not None:
+            shared.set(cachekey, in_cache, SHARED_COPY_TIMEOUT)
+        return in_cache
+    else:
+        stats.incr(kind, 'misses')
+        # do this to prevent dog piling
+        in_progress_key = 'django_css.in_progress.%s' % cachekey
+        failed_key = 'django_css.failed.%s' % cachekey
+        started = None
+        for attempt in xrange(BUILD_ATTEMPTS):
+            if cache.add(in_progress_key, True, 300):
+                try:
+                    # it may have been built since we looked
+                    output = cache.get(cachekey) or build(compressor, cachekey, inline, kind)
+                except:
+                    # tells the ones waiting not to try again
+                    cache.set(failed_key, True, FAILED_TIMEOUT)
+                    raise
+                else:
+                    cache.delete(failed_key)
+                finally:
+                    # also when the build failed, so nobody waits for it
+                    cache.delete(in_progress_key)
+                break
+            if started is None:
+                started = time.time()
+            while cache.get(in_progress_key):
+                sleep(0.1)
+            output = cache.get(cachekey)
+            if output is not None:
+                break
+            if cache.get(failed_key):
+                raise BuildError('Building %s failed in another thread or process' % cachekey)
+            # its result is gone from the cache already, one of us builds again
+        else:
+            # the cache keeps refusing the in-progress key, build regardless
+            output = build(compressor, cachekey, inline, kind)
+        if started is not None:
+            stats.incr(kind, 'waits')
+            stats.incr(kind, 'wait_time', time.time() - started)
+        if output and shared is not None:
+            shared.set(cachekey, output)
+        return output
+
 class CompressorNode(template.Node):
-    def __init__(self, nodelist, kind=None, xhtml=False):
+    def __init__(self, nodelist, kind=None, xhtml=False, merge=False, inline=False, loading=()):
         self.nodelist = nodelist
         self.kind = kind
         self.xhtml = xhtml
+        self.merge = merge
+        self.inline = inline
+        self.loading = list(loading)
 
     def render(self, context):
-        content = self.nodelist.render(context)
-        if 'MEDIA_URL' in context:
-            media_url = context['MEDIA_URL']
-        else:
-            media_url = settings.MEDIA_URL
-        if self.kind == 'css':
-            compressor = CssCompressor(content, xhtml=self.xhtml, media_url=media_url)
-        if self.kind == 'js':
-            compressor = JsCompressor(content, xhtml=self.xhtml, media_url=media_url)
-        in_cache = cache.get(compressor.cachekey)
-        if in_cache:
-            return in_cache
-        else:
-            # do this to prevent dog piling
-            in_progress_key = '%s.django_css.in_progress.%s' % (DOMAIN, compressor.cachekey)
-            added_to_cache = cache.add(in_progress_key, True, 300)
-            if added_to_cache:
-                output = compressor.output()
-                cache.set(compressor.cachekey, output, 2591000) # rebuilds the cache every 30 days if nothing has changed.
-                cache.set(in_progress_key, False, 300)
+        stop = timing.start('render', self.kind)
+        try:
+            content = self.nodelist.render(context)
+            if 'MEDIA_URL' in context:
+                media_url = context['MEDIA_URL']
             else:
-                while cache.get(in_progress_key):
-                    sleep(0.1)
-                output = cache.get(compressor.cachekey)
+                media_url = settings.MEDIA_URL
+            # Bundles are always built against COMPRESS_URL, so a per-request
+            # media host doesn't cause rebuilds; it's swapped in afterwards.
+            rewrite = media_url and media_url != settings.MEDIA_URL
+            if rewrite:
+                content = rewrite_media_url(content, media_url, settings.MEDIA_URL)
+            if self.merge and is_merging():
+                _merging.blocks[self.kind].append((content, media_url))
+                return ''
+            output = self.render_compressed(content)
+            if rewrite:
+                output = rewrite_media_url(output, settings.MEDIA_URL, media_url)
+            add_preloads(self.kind, output)
             return output
+        finally:
+            stop()
+
+    def render_compressed(self, content):
+        compressor = COMPRESSORS[self.kind](content, xhtml=self.xhtml)
+        compressor.extra_context = dict([(option, True) for option in self.loading])
+        variant = self.loading[:]
+        if self.inline:
+            variant.append('inline')
+        cachekey = ".".join([compressor.cachekey] + variant)
+        if settings.EXPLAIN_REBUILDS:
+            explain.record(self.block_name(compressor), cachekey, compressor.cachekey_components)
+        return render_cached(compressor, cachekey, inline=self.inline)
+
+    def block_name(self, compressor):
+        """
+        Names the block by its place in its template when TEMPLATE_DEBUG
+        keeps track of it, or else by a digest of its template code and the
+        files it links.
+        """
+        source = getattr(self, 'source', None)
+        if source:
+            return '%s:%s' % (source[0].name, source[1][0])
+        files = [h[1] for h in compressor.split_contents() if h[0] == 'file']
+        return '%s block %s of %s' % (self.kind, self.fingerprint(), ', '.join(files) or 'inline content')
+
+    def fingerprint(self):
+        """
+        Returns a digest of the block's template code, the same in every
+        process and for every render, whatever its variables hold.
+        """
+        if getattr(self, '_fingerprint', None) is None:
+            parts = []
+            for node in self.nodelist.get_nodes_by_type(template.Node):
+                if isinstance(node, template.TextNode):
+                    parts.append(node.s)
+                elif isinstance(node, template.VariableNode):
+                    parts.append(node.filter_expression.token)
+                else:
+                    parts.append(node.__class__.__name__)
+            self._fingerprint = get_hexdigest('|'.join(parts))[:8]
+        return self._fingerprint
+
+class MergedBundleNode(template.Node):
+    def __init__(self, kind, xhtml=False):
+        self.kind = kind
+        self.xhtml = xhtml
+
+    def render(self, context):
+        if not is_merging():
+            return ''
+        return MERGED_PLACEHOLDER % (self.kind, self.xhtml and ' xhtml' or '')
 
 @register.tag
 def compress(parser, token):
@@ -83,22 +355,56 @@ def compress(parser, token):
     Linked files must be on your COMPRESS_URL (which defaults to MEDIA_URL).
     If DEBUG is true off-site files will throw exceptions. If DEBUG is false
     they will be silently stripped.
+
+    With ``{% compress css inline %}`` the compressed CSS or JavaScript is
+    put in a <style> or <script> tag instead of being linked.
+
+    ``{% compress js async %}`` and ``{% compress js defer %}`` add the
+    async or defer attribute to the script tag.
+
+    With ``{% compress css merge %}`` and MergeBundlesMiddleware installed,
+    the block renders nothing and its contents are added to the page's
+    merged bundle, see ``compress_merged``. It can't be combined with
+    inline, async or defer.
     """
 
     nodelist = parser.parse(('endcompress',))
     parser.delete_first_token()
 
+    kind, options = parse_arguments(token, ('xhtml', 'merge', 'inline', 'async', 'defer'))
+    loading = [option for option in ('async', 'defer') if options.pop(option, False)]
+    if loading and kind != 'js':
+        raise template.TemplateSyntaxError("%r's async and defer options only apply to js." % token.split_contents()[0])
+    if options.get('merge') and (loading or options.get('inline')):
+        raise template.TemplateSyntaxError("%r's merge option can't be combined with inline, async or defer." % token.split_contents()[0])
+    return CompressorNode(nodelist, kind, loading=loading, **options)
+
+@register.tag
+def compress_merged(parser, token):
+    """
+    Marks where the merged bundle of the ``merge`` compress blocks of a kind
+    goes. Needs ``compressor.middleware.MergeBundlesMiddleware``.
+
+    Syntax::
+
+        {% compress_merged <js/css> [xhtml] %}
+    """
+    kind, options = parse_arguments(token, ('xhtml',))
+    return MergedBundleNode(kind, **options)
+
+def parse_arguments(token, allowed):
     args = token.split_contents()
 
-    if not (len(args) == 2 or len(args) == 3):
-        raise template.TemplateSyntaxError("%r tag requires either 1, 3 or 5 arguments." % args[0])
+    if len(args) < 2:
+        raise template.TemplateSyntaxError("%r tag requires at least one argument." % args[0])
 
     kind = args[1]
     if kind not in ('css', 'js'):
         raise template.TemplateSyntaxError("%r's argument must be 'js' or 'css'." % args[0])
-    
-    try:
-        xhtml = args[2] == "xhtml"
-    except:
-        xhtml = False
-    return CompressorNode(nodelist, kind, xhtml)
+
+    options = {}
+    for option in args[2:]:
+        if option not in allowed:
+            raise template.TemplateSyntaxError("%r's options must be among: %s." % (args[0], ", ".join(allowed)))
+        options[option] = True
+    return kind, options
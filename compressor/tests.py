@@ -1,15 +1,81 @@
 import os
 import re
+import shutil
+import socket
+import sys
+import threading
+import time
 from copy import copy
+from StringIO import StringIO
+from tempfile import NamedTemporaryFile, mkdtemp
 from textwrap import dedent
 from BeautifulSoup import BeautifulSoup
 
-from django.template import Template, Context
+from django.conf import settings as django_settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, reset_queries
+from django.http import Http404, HttpRequest, HttpResponse
+from django.template import Template, Context, TemplateSyntaxError
 from django.test import TestCase
 
-from compressor import CssCompressor, JsCompressor, UncompressableFileError
+from compressor import BuildError, CssCompressor, JsCompressor, UncompressableFileError, explain, stats, timing
+from compressor.benchmark import (bench_pipeline, bench_templatetag, bench_transcoding, compare, generate_ccss,
+    generate_css, generate_js, measure, percentile, profile_block, run_load)
 from compressor.conf import settings
-from compressor.utils import get_file_hash
+from compressor.filters import FilterBase, FilterError, FilterPipeline, get_pipeline, yui
+from compressor.filters.jsmin import JSMinFilter
+from compressor.management.commands import compress_gc
+from compressor.middleware import MergeBundlesMiddleware, PreloadMiddleware
+from compressor.sharedcache import SharedCache
+from compressor.signals import stage_timed
+from compressor.templatetags import compress as compress_module
+from compressor.templatetags.compress import render_cached
+from compressor.timing import clear_collectors
+from compressor.views import serve
+from compressor.utils import LIVE_BUNDLE_KEY, clear_domains, get_domain, get_file_hash, get_file_digest, get_hexdigest, iter_file, read_file
+
+class CountingFilter(FilterBase):
+    reusable = True
+    instances = 0
+    outputs = 0
+
+    def __init__(self, *args, **kwargs):
+        super(CountingFilter, self).__init__(*args, **kwargs)
+        CountingFilter.instances += 1
+
+    def input(self, **kwargs):
+        return self.content.upper()
+
+    def output(self, **kwargs):
+        CountingFilter.outputs += 1
+        return self.content.lower()
+
+
+
+class SlowFilter(FilterBase):
+
+    def output(self, **kwargs):
+        time.sleep(0.05)
+        return self.content
+
+class UnicodeFilter(FilterBase):
+
+    def output(self, **kwargs):
+        return u'var caf\xe9 = "\u2603";' + self.content.decode('utf-8')
+
+class FailingFilter(FilterBase):
+    builds = 0
+
+    def output(self, **kwargs):
+        FailingFilter.builds += 1
+        time.sleep(0.05)
+        raise FilterError('failed')
 
 class BaseTestCase(TestCase):
     
@@ -79,7 +145,7 @@ class CompressorTestCase(BaseTestCase):
                 'arguments': '*.ccss'
             },
         }            
-        self.assertRaises(Exception, self.cssNode.output)
+        self.assertRaises(Exception, CssCompressor(self.css).output)
 
     def test_css_split(self):
         out = [
@@ -125,7 +191,7 @@ class CompressorTestCase(BaseTestCase):
 <style type='text/css'>\nsmall {\n  font-size: 10px;\n}
 </style>\n<style type='text/css'>\nh1 {\n  font-weight: bold;\n}\n</style>
 """
-        self.assertEqual(dedent(css).strip(), dedent(self.cssNode.output()).strip())
+        self.assertEqual(dedent(css).strip(), dedent(CssCompressor(self.css).output()).strip())
         if os.path.exists(self.ccssFile):
             os.remove(self.ccssFile)
             
@@ -152,6 +218,11 @@ class CompressorTestCase(BaseTestCase):
         out = ['obj = {};', u'obj.value = "value";']
         self.assertEqual(out, self.jsNode.hunks)
 
+    def test_js_hunks_are_bytes(self):
+        jsNode = JsCompressor(u'<script type="text/javascript">obj.value = "caf\xe9";</script>')
+        self.assertEqual([str], [type(hunk) for hunk in jsNode.hunks])
+        self.assertEqual('obj.value="caf\xc3\xa9";', jsNode.combined)
+
     def test_js_concat(self):
         out = u'obj = {};\nobj.value = "value";'
         self.assertEqual(out, self.jsNode.concat())
@@ -162,12 +233,153 @@ class CompressorTestCase(BaseTestCase):
 
     def test_js_return_if_off(self):
         settings.COMPRESS = False
-        self.assertEqual(self.js, self.jsNode.output())
+        self.assertEqual(self.js, JsCompressor(self.js).output())
+
+    def test_snapshot(self):
+        compressor = JsCompressor(self.js)
+        settings.COMPRESS = False
+        self.assert_(compressor.settings.COMPRESS)
+        self.assertNotEqual(compressor.output(), self.js)
+        self.assertRaises(AttributeError, setattr, compressor.settings, 'COMPRESS', False)
+        self.assertEqual(type(compressor.settings.COMPRESS_JS_FILTERS), tuple)
+
+    def test_snapshot_pipeline(self):
+        css = '<link rel="stylesheet" href="/media/css/url/url1.css" type="text/css">'
+        expected = CssCompressor(css)
+        compressor = CssCompressor(css)
+        settings.OUTPUT_DIR = 'OTHER'
+        settings.OUTPUT_SHARD_DEPTH = 2
+        settings.ASSET_HOSTS = ['http://assets.example.com']
+        settings.CONTENT_CACHE_KEYS = True
+        settings.MMAP_THRESHOLD = 1
+        self.assertEqual(compressor.combined, expected.combined)
+        self.assertEqual(compressor.new_filepath, expected.new_filepath)
+        self.failIf('assets.example.com' in compressor.combined)
 
     def test_js_return_if_on(self):
         output = u'<script type="text/javascript" src="/media/CACHE/js/%s.js"></script>\n' % self.js_hash
         self.assertEqual(output, self.jsNode.output())
 
+    def test_cachekey_is_shared_across_sites(self):
+        site = Site.objects.get_current()
+        cachekey = JsCompressor(self.js).cachekey
+        settings.SITE_CACHE_KEYS = True
+        site_cachekey = JsCompressor(self.js).cachekey
+        self.assertEqual('%s.%s' % (site.domain, cachekey), site_cachekey)
+        site.domain = 'other.example.com'
+        site.save()
+        self.assertNotEqual(site_cachekey, JsCompressor(self.js).cachekey)
+        settings.SITE_CACHE_KEYS = False
+        self.assertEqual(cachekey, JsCompressor(self.js).cachekey)
+
+    def test_content_cachekey(self):
+        filename = os.path.join(settings.MEDIA_ROOT, 'js/one.js')
+        mtime = os.path.getmtime(filename)
+        try:
+            by_mtime = JsCompressor(self.js).cachekey
+            settings.CONTENT_CACHE_KEYS = True
+            by_content = JsCompressor(self.js).cachekey
+            os.utime(filename, (mtime - 3600, mtime - 3600))
+            self.assertEqual(by_content, JsCompressor(self.js).cachekey)
+            settings.CONTENT_CACHE_KEYS = False
+            self.assertNotEqual(by_mtime, JsCompressor(self.js).cachekey)
+        finally:
+            os.utime(filename, (mtime, mtime))
+
+
+class StreamingTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(StreamingTestCase, self).setUp()
+        settings.STREAMING = True
+        self.js = """
+        <script src="/media/js/one.js" type="text/javascript"></script>
+        <script type="text/javascript">obj.value = "value";</script>
+        """
+        self.css = """
+        <link rel="stylesheet" href="/media/css/one.css" type="text/css">
+        <style type="text/css">p { border:5px solid green;}</style>
+        <link rel="stylesheet" href="/media/css/two.css" type="text/css">
+        """
+
+    def test_js_stream(self):
+        spool, digest, size = JsCompressor(self.js).stream()
+        self.assertEqual('obj={};obj.value="value";', spool.read())
+        self.assertEqual(len('obj={};obj.value="value";'), size)
+
+    def test_hash_matches_combined(self):
+        for compressor_class, content in ((JsCompressor, self.js), (CssCompressor, self.css)):
+            streamed = compressor_class(content).hash
+            settings.STREAMING = False
+            self.assertEqual(compressor_class(content).hash, streamed)
+            settings.STREAMING = True
+
+    def test_js_return_if_on(self):
+        output = u'<script type="text/javascript" src="/media/CACHE/js/3f33b9146e12.js"></script>\n'
+        self.assertEqual(output, JsCompressor(self.js).output())
+
+    def test_unicode_filter_before_another(self):
+        settings.COMPRESS_JS_FILTERS = ['compressor.tests.UnicodeFilter', 'compressor.filters.jsmin.JSMinFilter']
+        spool, digest, size = JsCompressor(self.js).stream()
+        streamed = spool.read()
+        self.assertEqual(u'var caf\xe9="\u2603";obj={};obj.value="value";'.encode('utf-8'), streamed)
+        settings.STREAMING = False
+        self.assertEqual(JsCompressor(self.js).combined, streamed)
+
+    def test_mmap_reads(self):
+        settings.MMAP_THRESHOLD = 1
+        filename = os.path.join(settings.MEDIA_ROOT, 'css/one.css')
+        content = open(filename, 'rb').read()
+        self.assertEqual(content, ''.join(iter_file(filename, 4)))
+        self.assertEqual(content, read_file(filename))
+        self.assertEqual(get_hexdigest(content), get_file_digest(filename))
+        spool, digest, size = JsCompressor(self.js).stream()
+        self.assertEqual('obj={};obj.value="value";', spool.read())
+
+
+class FilterPipelineTestCase(BaseTestCase):
+
+    def test_pipeline_is_compiled_once(self):
+        pipeline = get_pipeline(settings.COMPRESS_JS_FILTERS, 'js')
+        self.assert_(pipeline is get_pipeline(list(settings.COMPRESS_JS_FILTERS), 'js'))
+        self.assertEqual([JSMinFilter], pipeline.classes)
+        self.assertEqual([], pipeline.input_filters)
+        self.assertEqual([JSMinFilter], pipeline.output_filters)
+
+    def test_reusable_filter(self):
+        pipeline = FilterPipeline(['compressor.tests.CountingFilter'], 'js')
+        CountingFilter.instances = 0
+        self.assertEqual('A = 1;', pipeline.apply('a = 1;', 'input'))
+        self.assertEqual('B = 2;', pipeline.apply('b = 2;', 'input'))
+        self.assertEqual(1, CountingFilter.instances)
+
+    def test_output_cache(self):
+        cache.clear()
+        settings.CACHE_FILTER_OUTPUT = True
+        settings.COMPRESS_JS_FILTERS = ['compressor.tests.CountingFilter']
+        CountingFilter.outputs = 0
+        js = '<script type="text/javascript">a = 1;</script>'
+        for i in range(2):
+            self.assertEqual('a = 1;', JsCompressor(js).combined)
+        self.assertEqual(1, CountingFilter.outputs)
+        settings.STREAMING = True
+        self.assertEqual(get_hexdigest('a = 1;')[:12], JsCompressor(js).hash)
+        self.assertEqual(1, CountingFilter.outputs)
+
+    def test_output_cachekey_fingerprint(self):
+        pipeline = FilterPipeline(['compressor.filters.yui.YUIJSFilter'], 'js')
+        key = pipeline.output_cachekey('digest', '/media/')
+        arguments = yui.JS_ARGUMENTS
+        yui.JS_ARGUMENTS = '--nomunge'
+        try:
+            self.assertNotEqual(key, pipeline.output_cachekey('digest', '/media/'))
+        finally:
+            yui.JS_ARGUMENTS = arguments
+        self.assertEqual(key, pipeline.output_cachekey('digest', '/media/'))
+
+    def test_missing_filter(self):
+        self.assertRaises(FilterError, get_pipeline, ['compressor.filters.Missing'])
+
 
 class CssAbsolutizingTestCase(BaseTestCase):
 
@@ -201,6 +413,19 @@ class CssAbsolutizingTestCase(BaseTestCase):
         output = "p { background: url('%simages/image.gif') }" % settings.MEDIA_URL
         self.assertEqual(output, filter.input(filename=filename, media_url=settings.MEDIA_URL))
         
+    def test_css_asset_hosts(self):
+        from compressor.filters.css_default import CssAbsoluteFilter
+        settings.ASSET_HOSTS = ['http://a.example.com', 'http://b.example.com/']
+        filename = os.path.join(settings.MEDIA_ROOT, 'css/url/test.css')
+        for media_url in ('/media/', 'http://media.example.com/media/'):
+            for image in ('image.gif', 'other.gif', 'third.png'):
+                path = '/media/images/%s' % image
+                host = settings.ASSET_HOSTS[int(get_hexdigest(path)[:8], 16) % 2].rstrip('/')
+                content = "p { background: url('../../images/%s') }" % image
+                output = "p { background: url('%s%s') }" % (host, path)
+                filter = CssAbsoluteFilter(content)
+                self.assertEqual(output, filter.input(filename=filename, media_url=media_url))
+
     def test_css_hunks(self):
         out = ["p { background: url('/media/images/test.png?%s'); }\np { background: url('/media/images/test.png?%s'); }\np { background: url('/media/images/test.png?%s'); }\np { background: url('/media/images/test.png?%s'); }\n" % ((self.url1_hash,)*4), 
                "p { background: url('/media/images/test.png?%s'); }\np { background: url('/media/images/test.png?%s'); }\np { background: url('/media/images/test.png?%s'); }\np { background: url('/media/images/test.png?%s'); }\n" % ((self.url2_hash,)*4)
@@ -254,3 +479,710 @@ class TemplatetagTestCase(BaseTestCase):
         out = u'<script type="text/javascript" src="/media/CACHE/js/3f33b9146e12.js"></script>'
         self.assertEqual(out, self.render(template, context))
 
+    def test_media_url_rewrite(self):
+        template = u"""{% load compress %}{% compress css %}
+        <link rel="stylesheet" href="{{ MEDIA_URL }}css/one.css" type="text/css">
+        <style type="text/css">p { border:5px solid green;}</style>
+        <link rel="stylesheet" href="{{ MEDIA_URL }}css/two.css" type="text/css">
+        {% endcompress %}
+        """
+        for media_url in ('http://cdn1.example.com/media/', 'http://cdn2.example.com/media/'):
+            out = u'<link rel="stylesheet" href="%sCACHE/css/f7c661b7a124.css" type="text/css">' % media_url
+            self.assertEqual(out, self.render(template, {'MEDIA_URL': media_url}))
+
+    def test_domain_lookup_is_memoized(self):
+        template = u"""{% load compress %}{% compress js %}
+        <script type="text/javascript">obj.value = "value";</script>
+        {% endcompress %}
+        """
+        debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            clear_domains()
+            self.render(template)
+            reset_queries()
+            cache.clear()
+            self.render(template)
+            self.assertEqual(0, len(connection.queries))
+            site = Site.objects.get_current()
+            site.domain = 'example.org'
+            site.save()
+            self.assertEqual('example.org', get_domain())
+        finally:
+            django_settings.DEBUG = debug
+
+    def test_merged_bundles(self):
+        template = u"""{% load compress %}<html><head>{% compress_merged css %}</head><body>
+        {% compress css merge %}
+        <link rel="stylesheet" href="{{ MEDIA_URL }}css/one.css" type="text/css">
+        {% endcompress %}
+        {% compress css merge %}
+        <style type="text/css">p { border:5px solid green;}</style>
+        <link rel="stylesheet" href="{{ MEDIA_URL }}css/two.css" type="text/css">
+        {% endcompress %}
+        </body></html>"""
+        context = { 'MEDIA_URL': settings.MEDIA_URL }
+        middleware = MergeBundlesMiddleware()
+        middleware.process_request(None)
+        response = middleware.process_response(None, HttpResponse(self.render(template, context)))
+        out = u'<link rel="stylesheet" href="/media/CACHE/css/f7c661b7a124.css" type="text/css">'
+        self.assertEqual(1, response.content.count('<link'))
+        self.assert_(out in response.content.split('</head>')[0], response.content)
+        self.assert_('compress_merged' not in response.content)
+        self.assertEqual(u'', self.render(u"{% load compress %}{% compress_merged js %}"))
+        # a cached merged bundle only costs the parse of each block
+        parses = []
+        def receiver(sender, stage, kind, **kwargs):
+            if stage == 'parse':
+                parses.append(kind)
+        stage_timed.connect(receiver)
+        try:
+            middleware.process_request(None)
+            again = middleware.process_response(None, HttpResponse(self.render(template, context)))
+        finally:
+            stage_timed.disconnect(receiver)
+        self.assertEqual(again.content, response.content)
+        self.assertEqual(parses, ['css', 'css'])
+
+    def test_merged_bundle_without_body(self):
+        template = u"""{% load compress %}<div>{% compress css merge %}
+        <link rel="stylesheet" href="{{ MEDIA_URL }}css/one.css" type="text/css">
+        {% endcompress %}</div>"""
+        context = { 'MEDIA_URL': settings.MEDIA_URL }
+        middleware = MergeBundlesMiddleware()
+        middleware.process_request(None)
+        response = middleware.process_response(None, HttpResponse(self.render(template, context)))
+        self.assert_(response.content.startswith('<div></div>'), response.content)
+        self.assertEqual(1, response.content.count('<link rel="stylesheet" href="/media/CACHE/css/'))
+
+    def test_merge_options(self):
+        for option in ('inline', 'async', 'defer'):
+            self.assertRaises(TemplateSyntaxError, self.render,
+                u"{%% load compress %%}{%% compress js merge %s %%}{%% endcompress %%}" % option)
+
+    def test_merge_without_middleware(self):
+        template = u"""{% load compress %}{% compress js merge %}
+        <script src="{{ MEDIA_URL }}js/one.js" type="text/javascript"></script>
+        <script type="text/javascript">obj.value = "value";</script>
+        {% endcompress %}
+        """
+        context = { 'MEDIA_URL': settings.MEDIA_URL }
+        out = u'<script type="text/javascript" src="/media/CACHE/js/3f33b9146e12.js"></script>'
+        self.assertEqual(out, self.render(template, context))
+
+    def test_unknown_option(self):
+        self.assertRaises(TemplateSyntaxError, self.render, u"{% load compress %}{% compress js foo %}{% endcompress %}")
+
+    def test_inline(self):
+        template = u"""{% load compress %}{% compress js inline %}
+        <script src="{{ MEDIA_URL }}js/one.js" type="text/javascript"></script>
+        <script type="text/javascript">obj.value = "value";</script>
+        {% endcompress %}
+        """
+        context = { 'MEDIA_URL': settings.MEDIA_URL }
+        out = u'<script type="text/javascript">obj={};obj.value="value";</script>'
+        self.assertEqual(out, self.render(template, context))
+
+    def test_inline_escaping(self):
+        js = NamedTemporaryFile(dir=os.path.join(settings.MEDIA_ROOT, 'js'), suffix='.js')
+        js.write('var tag = "</script><script>alert(1)</script>";')
+        js.flush()
+        template = u"""{%% load compress %%}{%% compress js inline %%}
+        <script src="{{ MEDIA_URL }}js/%s" type="text/javascript"></script>
+        {%% endcompress %%}""" % os.path.basename(js.name)
+        context = { 'MEDIA_URL': settings.MEDIA_URL }
+        out = u'<script type="text/javascript">var tag="<\\/script><script>alert(1)<\\/script>";</script>'
+        self.assertEqual(out, self.render(template, context))
+        js.close()
+        template = u"{% load compress %}{{ content|escape_style }}"
+        self.assertEqual(u'p:after{content:"<\\/STYLE>"}',
+            self.render(template, {'content': 'p:after{content:"</STYLE>"}'}))
+
+    def test_inline_threshold(self):
+        settings.INLINE_THRESHOLD = 1024
+        template = u"""{% load compress %}{% compress css %}
+        <style type="text/css">p { border:5px solid green;}</style>
+        {% endcompress %}
+        """
+        out = u'<style type="text/css">p { border:5px solid green;}</style>'
+        self.assertEqual(out, self.render(template))
+
+    def test_js_async_defer(self):
+        for option in ('async', 'defer'):
+            template = u"""{%% load compress %%}{%% compress js %s %%}
+            <script src="{{ MEDIA_URL }}js/one.js" type="text/javascript"></script>
+            <script type="text/javascript">obj.value = "value";</script>
+            {%% endcompress %%}
+            """ % option
+            context = { 'MEDIA_URL': settings.MEDIA_URL }
+            out = u'<script type="text/javascript" src="/media/CACHE/js/3f33b9146e12.js" %s></script>' % option
+            self.assertEqual(out, self.render(template, context))
+        self.assertRaises(TemplateSyntaxError, self.render, u"{% load compress %}{% compress css async %}{% endcompress %}")
+
+    def test_preload_header(self):
+        template = u"""{% load compress %}{% compress css %}
+        <link rel="stylesheet" href="{{ MEDIA_URL }}css/one.css" type="text/css">
+        <style type="text/css">p { border:5px solid green;}</style>
+        <link rel="stylesheet" href="{{ MEDIA_URL }}css/two.css" type="text/css">
+        {% endcompress %}{% compress js %}
+        <script src="{{ MEDIA_URL }}js/one.js" type="text/javascript"></script>
+        <script type="text/javascript">obj.value = "value";</script>
+        {% endcompress %}
+        """
+        context = { 'MEDIA_URL': settings.MEDIA_URL }
+        middleware = PreloadMiddleware()
+        middleware.process_request(None)
+        response = middleware.process_response(None, HttpResponse(self.render(template, context)))
+        self.assertEqual('</media/CACHE/css/f7c661b7a124.css>; rel=preload; as=style, '
+                         '</media/CACHE/js/3f33b9146e12.js>; rel=preload; as=script', response['Link'])
+
+
+class ServeTestCase(BaseTestCase):
+    urls = 'compressor.urls'
+
+    def setUp(self):
+        super(ServeTestCase, self).setUp()
+        self.js = """
+        <script src="/media/js/one.js" type="text/javascript"></script>
+        <script type="text/javascript">obj.value = "value";</script>
+        """
+        JsCompressor(self.js).save_file()
+
+    def test_serve(self):
+        response = self.client.get('/CACHE/js/3f33b9146e12.js')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('obj={};obj.value="value";', response.content)
+        self.assertEqual('"3f33b9146e12"', response['ETag'])
+        self.assert_('max-age=31536000' in response['Cache-Control'])
+        self.assertEqual('text/javascript', response['Content-Type'].split(';')[0])
+
+    def test_not_modified(self):
+        response = self.client.get('/CACHE/js/3f33b9146e12.js', HTTP_IF_NONE_MATCH='"3f33b9146e12"')
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('', response.content)
+
+    def test_ignores_server_file_wrapper(self):
+        def file_wrapper(fd, blksize):
+            raise AssertionError('the file wrapper of the server was used')
+        response = self.client.get('/CACHE/js/3f33b9146e12.js', **{'wsgi.file_wrapper': file_wrapper})
+        self.assertEqual('obj={};obj.value="value";', response.content)
+
+    def test_not_found(self):
+        self.assertRaises(Http404, serve, HttpRequest(), 'js/000000000000.js')
+        self.assertRaises(Http404, serve, HttpRequest(), '../../tests.py')
+
+    def test_serve_unsharded_url(self):
+        default_storage.delete('CACHE/js/3f33b9146e12.js')
+        settings.OUTPUT_SHARD_DEPTH = 2
+        JsCompressor(self.js).save_file()
+        self.assertEqual(200, self.client.get('/CACHE/js/3f33b9146e12.js').status_code)
+
+
+class ShardTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(ShardTestCase, self).setUp()
+        self.js = """
+        <script src="/media/js/one.js" type="text/javascript"></script>
+        <script type="text/javascript">obj.value = "value";</script>
+        """
+
+    def test_sharded_filepath(self):
+        settings.OUTPUT_SHARD_DEPTH = 2
+        self.assertEqual('CACHE/js/3f/33/3f33b9146e12.js', JsCompressor(self.js).new_filepath)
+
+    def test_shard_command(self):
+        default_storage.delete('CACHE/js/3f33b9146e12.js')
+        JsCompressor(self.js).save_file()
+        settings.OUTPUT_SHARD_DEPTH = 2
+        call_command('compress_shard', verbosity=0)
+        for path in ('CACHE/js/3f33b9146e12.js', 'CACHE/js/3f/33/3f33b9146e12.js'):
+            self.assertEqual('obj={};obj.value="value";', default_storage.open(path).read())
+        self.assert_(os.path.islink(default_storage.path('CACHE/js/3f33b9146e12.js')))
+        self.assertEqual(False, JsCompressor(self.js).save_file())
+
+
+class GarbageCollectionTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(GarbageCollectionTestCase, self).setUp()
+        cache.clear()
+        self.js = """
+        <script src="/media/js/one.js" type="text/javascript"></script>
+        <script type="text/javascript">obj.value = "value";</script>
+        """
+        JsCompressor(self.js).output()
+        self.stale = default_storage.save('CACHE/js/000000000000.js', ContentFile('stale'))
+        self.old = time.time() - 31 * 24 * 60 * 60
+        os.utime(default_storage.path(self.stale), (self.old, self.old))
+
+    def test_gc(self):
+        call_command('compress_gc', verbosity=0, dry_run=True)
+        self.assert_(default_storage.exists(self.stale))
+        call_command('compress_gc', verbosity=0)
+        self.failIf(default_storage.exists(self.stale))
+        self.assert_(default_storage.exists('CACHE/js/3f33b9146e12.js'))
+
+    def test_gc_live_marker(self):
+        # an old file is kept as long as its bundle's cache key is
+        bundle = 'CACHE/js/3f33b9146e12.js'
+        os.utime(default_storage.path(bundle), (self.old, self.old))
+        call_command('compress_gc', verbosity=0)
+        self.assert_(default_storage.exists(bundle))
+        # and a recent one when the key is gone
+        cache.delete(LIVE_BUNDLE_KEY % get_hexdigest(bundle))
+        os.utime(default_storage.path(bundle), None)
+        call_command('compress_gc', verbosity=0)
+        self.assert_(default_storage.exists(bundle))
+
+    def test_gc_without_live_bundles(self):
+        cache.clear()
+        try:
+            # through handle, as call_command turns CommandError into an exit
+            self.assertRaises(CommandError, compress_gc.Command().handle, verbosity=0)
+            self.assert_(default_storage.exists(self.stale))
+        finally:
+            default_storage.delete(self.stale)
+
+    def test_gc_manifest(self):
+        cache.clear()
+        manifest = NamedTemporaryFile(suffix='.json')
+        manifest.write('{"key": "<script src=\\"/media/%s\\"></script>"}' % self.stale)
+        manifest.flush()
+        call_command('compress_gc', verbosity=0, manifests=[manifest.name])
+        self.assert_(default_storage.exists(self.stale))
+        default_storage.delete(self.stale)
+
+
+class BenchmarkTestCase(BaseTestCase):
+
+    def test_corpora(self):
+        for generate in (generate_css, generate_js, generate_ccss):
+            corpus = generate(4096)
+            self.assert_(len(corpus) >= 4096)
+            self.assertEqual(corpus, generate(4096))
+            self.assertNotEqual(corpus, generate(4096, seed=1))
+
+    def test_pipeline(self):
+        results = bench_pipeline(sizes=(2048,), repeat=1, number=1)
+        self.assertEqual(sorted(results.keys()), ['ccss', 'css', 'js'])
+        timings = results['js']['2048']
+        for stage in ('parse', 'split_contents', 'hunks', 'concat', 'save_file', 'render_cold', 'render_warm'):
+            self.assert_(timings[stage] >= 0)
+        self.assert_('JSMinFilter' in timings['filters'])
+        # every filter is either timed or reported as skipped
+        self.assert_('YUIJSFilter' in timings['filters'] or 'YUIJSFilter' in timings['skipped_filters'])
+        self.assert_('CssAbsoluteFilter' in results['css']['2048']['filters'])
+        self.failIf(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'benchmark')))
+
+    def test_templatetag(self):
+        results = bench_templatetag(repeat=1)
+        self.failIf('import_error' in results, results.get('import_error'))
+        self.assert_(results['import'] > 0)
+        self.assertEqual((results['queries_cold'], results['queries_warm']), (1, 0))
+        self.assertEqual(settings.SITE_CACHE_KEYS, False)
+
+    def test_transcoding(self):
+        results = bench_transcoding(size=4096, repeat=1, number=1)
+        self.assertEqual(results['inline']['legacy']['copies'], 2)
+        self.assertEqual(results['inline']['hunks']['copies'], 1)
+        self.assertEqual(results['linked']['legacy']['copies'], 0)
+        self.assertEqual(results['linked']['combined']['copies'], 0)
+        self.failIf(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'benchmark')))
+
+    def test_measure(self):
+        calls = []
+        result = measure(lambda: calls.append(1), repeat=5, number=2)
+        self.assertEqual(len(calls), 10)
+        self.assert_(result['min'] <= result['median'])
+        self.assert_(result['stdev'] >= 0)
+
+    def test_compare(self):
+        baseline = {
+            'jsmin': {'median': 1.0, 'peak_memory': 2000},
+            'templatetag': {'median': 0.1, 'peak_memory': 0},
+        }
+        results = {
+            'jsmin': {'median': 1.1, 'peak_memory': 4000},
+            'templatetag': {'median': 0.2, 'peak_memory': 512},
+            'compressor': {'median': 5.0},
+        }
+        self.assertEqual(compare(results, baseline), [
+            ('jsmin', 'peak_memory', 2000, 4000),
+            ('templatetag', 'median', 0.1, 0.2),
+        ])
+        self.assertEqual(compare(results, baseline, threshold=1.5), [])
+        del results['jsmin']['peak_memory']
+        self.assertEqual(compare(results, baseline, threshold=1.5), [('jsmin', 'peak_memory', 2000, None)])
+
+
+    def test_profile_block(self):
+        content = '<script type="text/javascript">obj.value = "value";</script>'
+        bundle = JsCompressor(content).new_filepath
+        if default_storage.exists(bundle):
+            default_storage.delete(bundle)
+        results = profile_block('js', content, limit=100)
+        self.assertEqual([result['stage'] for result in results],
+                         ['parse', 'split_contents', 'cachekey', 'hunks', 'output filters', 'hash', 'save_file'])
+        self.assert_('function calls' in results[0]['profile'])
+        self.assert_(results[-1]['peak_memory'] >= 0)
+        # the bundle is saved on every run, but not where it's served from
+        self.assert_('(_save)' in results[-1]['profile'])
+        self.failIf(default_storage.exists(bundle))
+        self.assert_('(_save)' in profile_block('js', content, limit=100)[-1]['profile'])
+
+    def test_profile_compile(self):
+        results = profile_block('css', '<link rel="stylesheet" href="/media/css/three.ccss" type="text/css">', limit=100)
+        self.assert_('(compile)' in results[1]['profile'], results[1]['profile'])
+
+    def test_profile_command(self):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            call_command('compress_profile', snippet=u"""{% load compress %}{% compress css %}
+                <link rel="stylesheet" href="{{ MEDIA_URL }}css/one.css" type="text/css">
+                {% endcompress %}""", limit=1)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assert_('Block 1 of 1 (css)' in output, output)
+        self.assert_('output filters: ' in output)
+
+    def test_percentile(self):
+        timings = range(100, 0, -1)
+        self.assertEqual(percentile(timings, 0.5), 51)
+        self.assertEqual(percentile(timings, 0.99), 100)
+        self.assertEqual(percentile([], 0.5), None)
+
+    def test_load(self):
+        result = run_load(workers=4, renders=2, blocks=2, size=2048)
+        self.assertEqual((result['renders'], result['keys'], result['builds']), (8, 2, 2))
+        self.assertEqual(result['max_builds_per_key'], 1)
+        self.assert_(result['p50'] <= result['p99'] <= result['max'])
+        self.assert_(compress_module.cache is cache)
+        self.failIf(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'benchmark')))
+
+class TimingTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(TimingTestCase, self).setUp()
+        cache.clear()
+        self.stages = []
+        stage_timed.connect(self.receiver)
+        self.delete_bundles()
+        self.js = """
+        <script src="/media/js/one.js" type="text/javascript"></script>
+        <script type="text/javascript">obj.value = "value";</script>
+        """
+
+    def tearDown(self):
+        super(TimingTestCase, self).tearDown()
+        stage_timed.disconnect(self.receiver)
+        clear_collectors()
+        self.delete_bundles()
+
+    def delete_bundles(self):
+        if default_storage.exists('CACHE/js'):
+            for name in default_storage.listdir('CACHE/js')[1]:
+                default_storage.delete('CACHE/js/%s' % name)
+
+    def receiver(self, sender, stage, kind, duration, **kwargs):
+        self.stages.append((kind, stage))
+        self.assert_(duration >= 0)
+
+    def test_compressor_stages(self):
+        JsCompressor(self.js).output()
+        for stage in ('parse', 'read', 'filter_output', 'hash', 'save'):
+            self.assert_(('js', stage) in self.stages, stage)
+
+    def test_templatetag_stages(self):
+        template = u"""{% load compress %}{% compress js %}""" + self.js + """{% endcompress %}"""
+        Template(template).render(Context({}))
+        self.assert_(('js', 'build') in self.stages)
+        self.assertEqual(self.stages[-1], ('js', 'render'))
+
+    def test_render_stage_always_stops(self):
+        middleware = MergeBundlesMiddleware()
+        middleware.process_request(None)
+        Template(u"{% load compress %}{% compress js merge %}" + self.js + "{% endcompress %}").render(Context({}))
+        middleware.process_response(None, HttpResponse(''))
+        self.assert_(('js', 'render') in self.stages)
+        self.stages = []
+        template = Template(u'{% load compress %}{% compress js %}<script src="/media/js/missing.js"></script>{% endcompress %}')
+        self.assertRaises(OSError, template.render, Context({}))
+        self.assertEqual(self.stages[-1], ('js', 'render'))
+
+    def test_disabled(self):
+        stage_timed.disconnect(self.receiver)
+        self.assert_(timing.start('parse') is timing.noop)
+
+    def test_statsd(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        settings.TIMING_COLLECTOR = 'compressor.timing.StatsdCollector'
+        settings.STATSD_HOST, settings.STATSD_PORT = listener.getsockname()
+        JsCompressor(self.js).output()
+        packets = []
+        listener.settimeout(0.5)
+        try:
+            while True:
+                packets.append(listener.recv(1024))
+        except socket.timeout:
+            pass
+        listener.close()
+        self.assert_(packets)
+        for packet in packets:
+            self.assert_(re.match(r'^compressor\.js\.\w+:\d+\.\d{3}\|ms$', packet), packet)
+        self.assert_([packet for packet in packets if packet.startswith('compressor.js.save:')])
+
+
+class StatsTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(StatsTestCase, self).setUp()
+        cache.clear()
+        stats.reset()
+        self.template = Template(u"""{% load compress %}{% compress js %}
+        <script type="text/javascript">obj.value = "value";</script>
+        {% endcompress %}""")
+
+    def tearDown(self):
+        super(StatsTestCase, self).tearDown()
+        stats.reset()
+
+    def test_counters(self):
+        self.template.render(Context({}))
+        self.template.render(Context({}))
+        counters = stats.get_stats()['kinds']['js']
+        self.assertEqual((counters['hits'], counters['misses'], counters['rebuilds']), (1, 1, 1))
+        self.assert_(counters['bytes'] > 0)
+        bundle = stats.get_stats()['bundles'].values()[0]
+        self.assertEqual((bundle['kind'], bundle['builds']), ('js', 1))
+
+    def test_wait(self):
+        compressor = JsCompressor('<script type="text/javascript">obj.value = "value";</script>')
+        cache.set('django_css.in_progress.waiting', False, 300)
+        render_cached(compressor, 'waiting')
+        self.assertEqual(stats.get_stats()['kinds']['js']['waits'], 1)
+
+    def test_flush(self):
+        self.template.render(Context({}))
+        stats.flush()
+        self.assertEqual(stats.get_stats()['kinds'], {})
+        self.template.render(Context({}))
+        stats.flush()
+        counters = stats.get_totals()['kinds']['js']
+        self.assertEqual((counters['hits'], counters['misses']), (1, 1))
+        settings.STATS_FLUSH_INTERVAL = 0.000001
+        self.template.render(Context({}))
+        self.assertEqual(stats.get_totals()['kinds']['js']['hits'], 2)
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            call_command('compress_stats', reset=True)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assert_(output.startswith('js: 3 lookups, 66.7% hits, 1 misses, 1 rebuilds'), output)
+        self.assert_('Slowest bundles:' in output)
+        self.assertEqual(stats.get_totals()['kinds'], {})
+
+
+class ExplainTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(ExplainTestCase, self).setUp()
+        cache.clear()
+        settings.EXPLAIN_REBUILDS = True
+        self.js = """
+        <script src="/media/js/one.js" type="text/javascript"></script>
+        <script type="text/javascript">obj.value = "value";</script>
+        """
+        self.template = Template(u"{% load compress %}{% compress js %}" + self.js + "{% endcompress %}")
+        self.filename = os.path.realpath(os.path.join(settings.MEDIA_ROOT, 'js', 'one.js'))
+        self.mtime = os.path.getmtime(self.filename)
+
+    def tearDown(self):
+        super(ExplainTestCase, self).tearDown()
+        os.utime(self.filename, (self.mtime, self.mtime))
+
+    def test_components(self):
+        components = JsCompressor(self.js).cachekey_components
+        self.assertEqual([name for name, value in components],
+                         ['content', 'media_url', 'file %s' % self.filename, 'COMPRESS'])
+        self.assertEqual(components[2][1], str(self.mtime))
+
+    def test_explain(self):
+        self.template.render(Context({}))
+        self.template.render(Context({}))
+        os.utime(self.filename, (self.mtime + 60, self.mtime + 60))
+        self.template.render(Context({}))
+        block = 'js block %s of %s' % (self.template.nodelist[1].fingerprint(), self.filename)
+        self.assertEqual(explain.get_blocks(), [block])
+        self.assertEqual(len(explain.get_history(block)), 2)
+        changes = explain.explain(block)[0][2]
+        self.assertEqual(changes, [('file %s' % self.filename, str(self.mtime), str(self.mtime + 60))])
+
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            call_command('compress_explain', clear=True)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assert_(output.startswith('%s: 2 cache keys' % block), output)
+        self.assert_('file %s changed from' % self.filename in output)
+        self.assertEqual(explain.get_blocks(), [])
+
+    def test_inline_blocks(self):
+        templates = [Template(u'{%% load compress %%}{%% compress js %%}'
+                              u'<script type="text/javascript">var block = %d;</script>'
+                              u'{%% endcompress %%}' % i) for i in range(2)]
+        for template in templates:
+            template.render(Context({}))
+            template.render(Context({}))
+        blocks = explain.get_blocks()
+        self.assertEqual(len(blocks), 2)
+        for block in blocks:
+            self.assertEqual(len(explain.get_history(block)), 1)
+        # the same code gets the same name when parsed again
+        self.assertEqual(templates[0].nodelist[1].fingerprint(), Template(u'{% load compress %}{% compress js %}'
+            u'<script type="text/javascript">var block = 0;</script>{% endcompress %}').nodelist[1].fingerprint())
+
+
+class SharedCacheTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(SharedCacheTestCase, self).setUp()
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'shared')
+        self.shared = SharedCache(self.path, slots=4, slot_size=256)
+
+    def tearDown(self):
+        super(SharedCacheTestCase, self).tearDown()
+        self.shared.close()
+        shutil.rmtree(self.directory)
+
+    def test_get_set(self):
+        self.assertEqual(self.shared.get('key'), None)
+        self.assert_(self.shared.set('key', u'caf\xe9'))
+        self.assertEqual(self.shared.get('key'), u'caf\xe9')
+        self.shared.set('key', 'other')
+        self.assertEqual(self.shared.get('key'), 'other')
+        self.failIf(self.shared.set('big', 'x' * 256))
+        self.assertEqual(self.shared.get('big'), None)
+        self.shared.clear()
+        self.assertEqual(self.shared.get('key'), None)
+
+    def test_timeout(self):
+        self.shared.set('key', 'value', 60)
+        self.assertEqual(self.shared.get('key'), 'value')
+        self.shared.set('key', 'value', -1)
+        self.assertEqual(self.shared.get('key'), None)
+
+    def test_eviction(self):
+        for i in range(4):
+            self.shared.set('key%d' % i, 'value%d' % i)
+            time.sleep(0.01)
+        for i in (0, 2, 3):
+            self.assertEqual(self.shared.get('key%d' % i), 'value%d' % i)
+        self.shared.set('key4', 'value4')
+        self.assertEqual(self.shared.get('key1'), None)
+        for i in (0, 2, 3, 4):
+            self.assertEqual(self.shared.get('key%d' % i), 'value%d' % i)
+
+    def test_processes(self):
+        pid = os.fork()
+        if not pid:
+            try:
+                SharedCache(self.path, slots=4, slot_size=256).set('key', 'from child')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.shared.get('key'), 'from child')
+        # another geometry gets a file of its own and leaves this one alone
+        other = SharedCache(self.path, slots=8, slot_size=256)
+        self.assertEqual(other.get('key'), None)
+        other.close()
+        self.assertEqual(os.path.getsize(self.shared.path), self.shared.size)
+        self.assertEqual(self.shared.get('key'), 'from child')
+
+    def test_bad_file(self):
+        fd = open(self.path + '.2.256', 'w')
+        fd.write('not a shared cache')
+        fd.close()
+        self.assertRaises(ImproperlyConfigured, SharedCache, self.path, slots=2, slot_size=256)
+
+    def test_render(self):
+        cache.clear()
+        stats.reset()
+        settings.SHARED_CACHE_PATH = self.path
+        template = Template(u"""{% load compress %}{% compress js %}
+        <script type="text/javascript">obj.value = "value";</script>
+        {% endcompress %}""")
+        output = template.render(Context({}))
+        cache.clear()
+        self.assertEqual(template.render(Context({})), output)
+        counters = stats.get_stats()['kinds']['js']
+        self.assertEqual((counters['shared_hits'], counters['rebuilds']), (1, 1))
+        stats.reset()
+
+
+class ThreadingTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(ThreadingTestCase, self).setUp()
+        cache.clear()
+        stats.reset()
+        settings.COMPRESS_JS_FILTERS = ['compressor.tests.SlowFilter']
+        self.templates = [Template(u"""{%% load compress %%}{%% compress js %%}
+        <script src="/media/js/one.js" type="text/javascript"></script>
+        <script type="text/javascript">obj.value = %d;</script>
+        {%% endcompress %%}""" % i) for i in range(3)]
+
+    def tearDown(self):
+        super(ThreadingTestCase, self).tearDown()
+        stats.reset()
+
+    def test_concurrent_renders(self):
+        start = threading.Event()
+        outputs = []
+        errors = []
+        def render(template):
+            start.wait()
+            try:
+                outputs.append((template, template.render(Context({}))))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=render, args=(self.templates[i % 3],)) for i in range(24)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(outputs), 24)
+        for template in self.templates:
+            rendered = set([output for t, output in outputs if t is template])
+            self.assertEqual(len(rendered), 1)
+            self.assert_('/media/CACHE/js/' in rendered.pop())
+        self.assertEqual(stats.get_stats()['kinds']['js']['rebuilds'], 3)
+
+    def test_concurrent_failing_build(self):
+        settings.COMPRESS_JS_FILTERS = ['compressor.tests.FailingFilter']
+        FailingFilter.builds = 0
+        start = threading.Event()
+        errors = []
+        def render():
+            start.wait()
+            try:
+                self.templates[0].render(Context({}))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=render) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 10)
+        self.assertEqual(FailingFilter.builds, 1)
+        self.assertEqual(len([e for e in errors if isinstance(e, BuildError)]), 9)
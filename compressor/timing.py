@@ -0,0 +1,76 @@
+"""
+Timing of the stages a bundle goes through: parsing the block, stat calls,
+compiling, reading files, filtering, hashing, saving and rendering the tag.
+
+Every stage sends the ``compressor.signals.stage_timed`` signal and is handed
+to the collector set in COMPRESS_TIMING_COLLECTOR, if any. Stages aren't
+timed at all while neither is used.
+"""
+import socket
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from compressor.conf import settings
+from compressor.signals import stage_timed
+
+_collectors = {}
+
+def get_collector():
+    """
+    Returns the instance of the COMPRESS_TIMING_COLLECTOR class, created on
+    first use, or None.
+    """
+    path = settings.TIMING_COLLECTOR
+    if not path:
+        return None
+    collector = _collectors.get(path)
+    if collector is None:
+        module, attr = path.rsplit('.', 1)
+        try:
+            cls = getattr(import_module(module), attr)
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured('Error importing timing collector %s: "%s"' % (path, e))
+        collector = _collectors.setdefault(path, cls())
+    return collector
+
+def clear_collectors():
+    _collectors.clear()
+
+def noop():
+    pass
+
+def start(stage, kind=None):
+    """
+    Starts timing a stage and returns the function that stops it.
+    """
+    collector = get_collector()
+    if collector is None and not stage_timed.receivers:
+        return noop
+    started = time.time()
+    def stop():
+        duration = time.time() - started
+        stage_timed.send(sender=None, stage=stage, kind=kind, duration=duration)
+        if collector is not None:
+            collector.timing(stage, duration, kind)
+    return stop
+
+
+class StatsdCollector(object):
+    """
+    Sends each stage's duration to statsd over UDP, as a timer named
+    ``<COMPRESS_STATSD_PREFIX>.<kind>.<stage>``.
+    """
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (host or settings.STATSD_HOST, port or settings.STATSD_PORT)
+        self.prefix = prefix is None and settings.STATSD_PREFIX or prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, stage, duration, kind=None):
+        name = ".".join([bit for bit in (self.prefix, kind, stage) if bit])
+        try:
+            self.socket.sendto("%s:%.3f|ms" % (name, duration * 1000), self.address)
+        except socket.error:
+            # statsd is best effort, it mustn't break rendering
+            pass
@@ -0,0 +1,9 @@
+import re
+
+from django.conf.urls.defaults import *
+
+from compressor.conf import settings
+
+urlpatterns = patterns('compressor.views',
+    url(r'^%s/(?P<path>.+)$' % re.escape(settings.OUTPUT_DIR.strip('/')), 'serve', name='compressor_serve'),
+)
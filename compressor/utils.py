@@ -1,4 +1,10 @@
 import os
+import mmap
+import time
+import codecs
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.utils.encoding import smart_str
 from django.utils.hashcompat import sha_constructor
 from compressor.conf import settings
@@ -7,13 +13,150 @@ def get_hexdigest(plaintext):
     p = smart_str(plaintext)
     return sha_constructor(p).hexdigest()
 
-def get_file_hash(filename):
+def iter_file(filename, chunk_size=64 * 1024, settings=settings):
+    """
+    Yields the contents of a file in blocks, or in one piece if chunk_size is
+    None. Files of COMPRESS_MMAP_THRESHOLD bytes or more are mapped into memory
+    rather than read through a buffer.
+    """
+    fd = open(filename, 'rb')
+    try:
+        size = os.fstat(fd.fileno()).st_size
+        if not size or size < settings.MMAP_THRESHOLD:
+            yield fd.read()
+            return
+        mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        chunk_size = chunk_size or size
+        try:
+            for offset in xrange(0, size, chunk_size):
+                yield mapped[offset:offset + chunk_size]
+        finally:
+            mapped.close()
+    finally:
+        fd.close()
+
+def read_file(filename, settings=settings):
+    return "".join(iter_file(filename, None, settings))
+
+def get_file_digest(filename, settings=settings):
+    """
+    Returns the hexdigest of a file's contents, updated block by block.
+    """
+    digest = sha_constructor()
+    for block in iter_file(filename, settings=settings):
+        digest.update(block)
+    return digest.hexdigest()
+
+_file_digests = {}
+
+def get_content_digest(filename, settings=settings):
+    """
+    Returns get_file_digest(filename), memoized per inode and mtime so an
+    unchanged file is only read once per process.
+    """
+    stat = os.stat(filename)
+    inode = (stat.st_dev, stat.st_ino)
+    version = (stat.st_mtime, stat.st_size)
+    cached = _file_digests.get(inode)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    digest = get_file_digest(filename, settings)
+    _file_digests[inode] = (version, digest)
+    return digest
+
+_domains = {}
+
+def get_domain():
+    """
+    Returns the current Site's domain, or '' without the sites framework.
+    Looked up once per SITE_ID and forgotten whenever a Site is changed.
+    """
+    if 'django.contrib.sites' not in django_settings.INSTALLED_APPS:
+        return ''
+    site_id = getattr(django_settings, 'SITE_ID', None)
+    if site_id in _domains:
+        return _domains[site_id]
+    try:
+        from django.contrib.sites.models import Site
+        domain = Site.objects.get_current().domain
+    except Exception:
+        return ''
+    _domains[site_id] = domain
+    return domain
+
+def clear_domains(**kwargs):
+    _domains.clear()
+
+def is_utf8(charset):
+    return codecs.lookup(charset).name == 'utf-8'
+
+def get_output_path(prefix, filename, settings=settings):
+    """
+    Returns the storage path of a bundle, nested in COMPRESS_OUTPUT_SHARD_DEPTH
+    directories named after the start of its filename.
+    """
+    shards = [filename[i * 2:i * 2 + 2] for i in range(settings.OUTPUT_SHARD_DEPTH)]
+    return "/".join([settings.OUTPUT_DIR.strip('/'), prefix] + shards + [filename])
+
+LIVE_BUNDLES_KEY = 'django_compressor.live_bundles'
+LIVE_BUNDLE_KEY = 'django_compressor.live.%s'
+LIVE_BUNDLES_TIMEOUT = 2591000
+
+def mark_live(path):
+    """
+    Records that a bundle was just linked from a freshly built tag, for the
+    compress_gc command: it gets a cache key of its own for as long as the
+    tag stays cached, and its file is touched so that its age says the same
+    if the key is evicted first. LIVE_BUNDLES_KEY tells compress_gc since
+    when bundles are being recorded.
+    """
+    now = time.time()
+    cache.add(LIVE_BUNDLES_KEY, now, LIVE_BUNDLES_TIMEOUT)
+    cache.set(LIVE_BUNDLE_KEY % get_hexdigest(path), now, LIVE_BUNDLES_TIMEOUT)
+    try:
+        os.utime(default_storage.path(path), None)
+    except (NotImplementedError, OSError):
+        pass
+
+def get_live_bundles(paths):
+    """
+    Returns the ones of paths that mark_live recorded and are still in the
+    cache.
+    """
+    keys = dict([(LIVE_BUNDLE_KEY % get_hexdigest(path), path) for path in paths])
+    return [keys[key] for key in cache.get_many(keys.keys())]
+
+def is_recording_live_bundles():
+    return cache.get(LIVE_BUNDLES_KEY) is not None
+
+def get_file_hash(filename, settings=settings):
     media_root = os.path.abspath(settings.MEDIA_ROOT)
     if not filename.startswith(media_root):
         filename = os.path.join(media_root, filename)
     try:
+        if settings.CONTENT_CACHE_KEYS:
+            return get_content_digest(filename, settings)[:12]
         mtime = os.path.getmtime(filename)
         return get_hexdigest(str(int(mtime)))[:12]
     except OSError:
         return None
-    
\ No newline at end of file
+    
+
+class HashedFile(object):
+    """
+    Wraps a writable file object, keeping a running digest and size of
+    everything written through it.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.digest = sha_constructor()
+        self.size = 0
+
+    def write(self, data):
+        data = smart_str(data)
+        self.digest.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
@@ -0,0 +1,59 @@
+import os
+import time
+import mimetypes
+import posixpath
+
+from django.core.exceptions import SuspiciousOperation
+from django.core.files.storage import default_storage
+from django.core.servers.basehttp import FileWrapper
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from compressor.conf import settings
+from compressor.utils import get_output_path
+
+# Bundle names contain a hash of their content, so they never change.
+MAX_AGE = 365 * 24 * 60 * 60
+BLOCK_SIZE = 64 * 1024
+
+def serve(request, path):
+    """
+    Serves a bundle from COMPRESS_OUTPUT_DIR, for deployments without a
+    front-end server. The hash in the filename is used as the ETag, and the
+    file is streamed in blocks rather than read into memory.
+
+    Only works with storage backends that keep files on the local disk.
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    if path.startswith('..'):
+        raise Http404('"%s" is not in COMPRESS_OUTPUT_DIR' % path)
+    name = "/".join((settings.OUTPUT_DIR.strip('/'), path))
+    try:
+        filename = default_storage.path(name)
+    except (NotImplementedError, SuspiciousOperation):
+        raise Http404('"%s" can not be served' % path)
+    if not os.path.isfile(filename) and settings.OUTPUT_SHARD_DEPTH and path.count('/') == 1:
+        # a bundle linked before COMPRESS_OUTPUT_SHARD_DEPTH was set
+        filename = default_storage.path(get_output_path(*path.split('/')))
+    if not os.path.isfile(filename):
+        raise Http404('"%s" does not exist' % path)
+    stat = os.stat(filename)
+    etag = '"%s"' % os.path.splitext(os.path.basename(filename))[0]
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        not_modified = etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    else:
+        not_modified = not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                                              stat.st_mtime, stat.st_size)
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = HttpResponse(FileWrapper(open(filename, 'rb'), BLOCK_SIZE), content_type=content_type)
+        response['Content-Length'] = str(stat.st_size)
+        response['Last-Modified'] = http_date(stat.st_mtime)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=%d, immutable' % MAX_AGE
+    response['Expires'] = http_date(time.time() + MAX_AGE)
+    return response
@@ -21,6 +21,8 @@ setup(
         'compressor.conf',
         'compressor.filters',
         'compressor.filters.jsmin',
+        'compressor.management',
+        'compressor.management.commands',
         'compressor.templatetags',
     ],
     package_data = {'compressor': ['templates/compressor/*.html']},